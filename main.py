@@ -1,6 +1,8 @@
 # main.py
 import os
+import sys
 import json
+import argparse
 import threading
 import time
 from dotenv import load_dotenv
@@ -8,7 +10,7 @@ from dotenv import load_dotenv
 # Web server + BotManager được khởi tạo từ ENV trong part4
 from trading_bot_lib_part4 import run_api_server, initialize_bot_manager
 import trading_bot_lib_part4 as part4  # để truy cập part4.bot_manager (global)
-from trading_bot_lib_part1 import logger
+from trading_bot_lib_part1 import logger, db_manager
 
 
 load_dotenv()
@@ -137,6 +139,45 @@ def bootstrap_bots_from_env():
             logger.warning(f"❌ Lỗi bootstrap bot: {e}")
 
 
+def run_export(argv):
+    """
+    CLI export lịch sử, ví dụ:
+    python main.py export trades --format ndjson --since 2024-01-01 --until 2024-02-01 -o jan.ndjson
+    """
+    parser = argparse.ArgumentParser(prog="main.py export", description="Export trade/position history (COPY, stream)")
+    parser.add_argument("kind", choices=list(db_manager.EXPORT_SOURCES))
+    parser.add_argument("--format", dest="fmt", choices=list(db_manager.EXPORT_FORMATS), default="csv")
+    parser.add_argument("--bot-id")
+    parser.add_argument("--user-id", type=int)
+    parser.add_argument("--since", help="Thời điểm bắt đầu (ISO, bao gồm)")
+    parser.add_argument("--until", help="Thời điểm kết thúc (ISO, không bao gồm)")
+    parser.add_argument("-o", "--output", help="File đích (mặc định stdout)")
+    args = parser.parse_args(argv)
+
+    filters = dict(bot_id=args.bot_id, user_id=args.user_id, since=args.since, until=args.until)
+    if args.output:
+        with open(args.output, "wb") as out:
+            db_manager.copy_export(out, args.kind, args.fmt, **filters)
+        logger.info(f"✅ Đã export {args.kind} ra {args.output}")
+    else:
+        db_manager.copy_export(sys.stdout.buffer, args.kind, args.fmt, **filters)
+        sys.stdout.buffer.flush()
+
+
+def run_backfill_rollup(argv):
+    """
+    CLI tính lại bảng daily_pnl_rollup từ trade_history, ví dụ:
+    python main.py backfill-rollup --since 2024-01-01
+    """
+    parser = argparse.ArgumentParser(prog="main.py backfill-rollup",
+                                     description="Tính lại daily_pnl_rollup từ trade_history")
+    parser.add_argument("--since", help="Ngày bắt đầu (bao gồm), mặc định toàn bộ")
+    parser.add_argument("--until", help="Ngày kết thúc (không bao gồm)")
+    args = parser.parse_args(argv)
+    days = db_manager.backfill_daily_rollup(since=args.since, until=args.until)
+    print(f"Đã tính lại {days} ngày")
+
+
 def start_web_in_thread(host="0.0.0.0", port=None, debug=False):
     """
     Chạy web server (Flask/SocketIO) trên thread riêng.
@@ -184,5 +225,10 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "export":
+        run_export(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "backfill-rollup":
+        run_backfill_rollup(sys.argv[2:])
+    else:
+        main()
 
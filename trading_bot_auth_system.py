@@ -1,8 +1,8 @@
 # trading_bot_auth_system.py
 # PHẦN 5: HỆ THỐNG ĐĂNG NHẬP ĐA NGƯỜI DÙNG VỚI JWT
 
-from trading_bot_lib_part1 import db_manager, logger
-from trading_bot_lib_part4 import get_database_connection, send_telegram
+from trading_bot_lib_part1 import db_manager, logger, Migration, apply_migrations, monthly_partition_statements
+from trading_bot_lib_part4 import send_telegram, export_response
 
 import os
 import time
@@ -22,9 +22,8 @@ JWT_ALGORITHM = "HS256"
 JWT_EXPIRE_HOURS = 24
 
 # ================== INIT DATABASE ==================
-def init_auth_tables():
-    """Khởi tạo bảng người dùng trong database"""
-    init_queries = [
+AUTH_MIGRATIONS = [
+    Migration(1, "Bảng người dùng", (
         """
         CREATE TABLE IF NOT EXISTS users (
             id SERIAL PRIMARY KEY,
@@ -43,7 +42,7 @@ def init_auth_tables():
             last_login TIMESTAMP
         )
         """,
-        
+    
         """
         CREATE TABLE IF NOT EXISTS user_sessions (
             id SERIAL PRIMARY KEY,
@@ -57,7 +56,7 @@ def init_auth_tables():
             FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
         )
         """,
-        
+    
         """
         CREATE TABLE IF NOT EXISTS user_balance_logs (
             id SERIAL PRIMARY KEY,
@@ -71,30 +70,67 @@ def init_auth_tables():
             FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
         )
         """,
-        
+    
         "CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)",
         "CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)",
         "CREATE INDEX IF NOT EXISTS idx_user_sessions_token ON user_sessions(session_token)",
-        "CREATE INDEX IF NOT EXISTS idx_user_sessions_user_id ON user_sessions(user_id)"
-    ]
-    
-    conn = None
+        "CREATE INDEX IF NOT EXISTS idx_user_sessions_user_id ON user_sessions(user_id)",
+    )),
+    # Bot theo người dùng: cột user_id mà các API người dùng truy vấn, index theo đúng query
+    Migration(2, "Liên kết bot_configs với users và index cho query nóng", (
+        "ALTER TABLE bot_configs ADD COLUMN IF NOT EXISTS user_id INTEGER",
+        """
+        CREATE INDEX IF NOT EXISTS idx_bot_configs_user_active
+        ON bot_configs(user_id, created_at DESC) WHERE deleted_at IS NULL
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_user_balance_logs_user_time ON user_balance_logs(user_id, created_at DESC)",
+        # UNIQUE đã tạo index cho các cột này
+        "DROP INDEX IF EXISTS idx_users_username",
+        "DROP INDEX IF EXISTS idx_users_email",
+        "DROP INDEX IF EXISTS idx_user_sessions_token",
+    )),
+    Migration(3, "Partition user_balance_logs theo tháng", monthly_partition_statements(
+        "user_balance_logs",
+        """
+            id INTEGER NOT NULL DEFAULT nextval('user_balance_logs_id_seq'),
+            user_id INTEGER NOT NULL,
+            total_balance DECIMAL(20, 8) DEFAULT 0,
+            available_balance DECIMAL(20, 8) DEFAULT 0,
+            margin_balance DECIMAL(20, 8) DEFAULT 0,
+            maint_margin DECIMAL(20, 8) DEFAULT 0,
+            margin_ratio DECIMAL(10, 4) DEFAULT 0,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, created_at),
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        """,
+        ['id', 'user_id', 'total_balance', 'available_balance', 'margin_balance', 'maint_margin',
+         'margin_ratio', 'created_at'],
+        indexes=(
+            "CREATE INDEX IF NOT EXISTS idx_user_balance_logs_user_time ON user_balance_logs(user_id, created_at DESC)",
+        ),
+        old_indexes=("idx_user_balance_logs_user_time",),
+    )),
+]
+
+# Log số dư giữ lại theo ngày, dọn bằng cách bỏ partition cùng trade_history
+db_manager.register_partitioned_table(
+    "user_balance_logs", retention_days=int(os.getenv("BALANCE_LOG_RETENTION_DAYS", "90"))
+)
+
+def init_auth_tables():
+    """Khởi tạo bảng người dùng trong database"""
     try:
-        conn = get_database_connection()
-        if not conn:
-            logger.error("❌ Không thể kết nối database để tạo bảng users")
-            return False
-        
-        cursor = conn.cursor()
-        for query in init_queries:
-            cursor.execute(query)
-        
-        conn.commit()
-        logger.info("✅ Đã khởi tạo bảng người dùng")
+        with db_manager.connection() as conn:
+            if not apply_migrations(conn, "auth", AUTH_MIGRATIONS):
+                return False
+            logger.info("✅ Đã khởi tạo bảng người dùng")
+            
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM users")
+            no_users = cursor.fetchone()[0] == 0
         
         # Tạo tài khoản admin mặc định nếu không có user nào
-        cursor.execute("SELECT COUNT(*) FROM users")
-        if cursor.fetchone()[0] == 0:
+        if no_users:
             create_default_admin()
             logger.info("✅ Đã tạo tài khoản admin mặc định")
         
@@ -102,12 +138,7 @@ def init_auth_tables():
         
     except Exception as e:
         logger.error(f"❌ Lỗi khởi tạo bảng auth: {str(e)}")
-        if conn:
-            conn.rollback()
         return False
-    finally:
-        if conn:
-            conn.close()
 
 def create_default_admin():
     """Tạo tài khoản admin mặc định"""
@@ -227,29 +258,26 @@ def register_auth_routes(app):
             if len(password) < 6:
                 return jsonify({"error": "Mật khẩu phải có ít nhất 6 ký tự"}), 400
             
-            # Kiểm tra username/email đã tồn tại
-            conn = get_database_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute("SELECT id FROM users WHERE username = %s OR email = %s", 
-                          (username, email))
-            if cursor.fetchone():
-                conn.close()
-                return jsonify({"error": "Username hoặc email đã tồn tại"}), 400
-            
-            # Hash mật khẩu
+            # Hash mật khẩu (trước khi giữ connection)
             salt, password_hash = hash_password(password)
             
-            # Tạo user
-            cursor.execute("""
-                INSERT INTO users (username, email, password_hash, password_salt, is_active)
-                VALUES (%s, %s, %s, %s, %s)
-                RETURNING id, username, email, created_at
-            """, (username, email, password_hash, salt, True))
-            
-            user = cursor.fetchone()
-            conn.commit()
-            conn.close()
+            with db_manager.connection() as conn:
+                cursor = conn.cursor()
+                
+                # Kiểm tra username/email đã tồn tại
+                cursor.execute("SELECT id FROM users WHERE username = %s OR email = %s", 
+                              (username, email))
+                if cursor.fetchone():
+                    return jsonify({"error": "Username hoặc email đã tồn tại"}), 400
+                
+                # Tạo user
+                cursor.execute("""
+                    INSERT INTO users (username, email, password_hash, password_salt, is_active)
+                    VALUES (%s, %s, %s, %s, %s)
+                    RETURNING id, username, email, created_at
+                """, (username, email, password_hash, salt, True))
+                
+                user = cursor.fetchone()
             
             logger.info(f"✅ Đã đăng ký user mới: {username}")
             
@@ -279,35 +307,28 @@ def register_auth_routes(app):
             if not username or not password:
                 return jsonify({"error": "Thiếu username hoặc password"}), 400
             
-            conn = get_database_connection()
-            cursor = conn.cursor()
-            
             # Lấy thông tin user
-            cursor.execute("""
-                SELECT id, username, email, password_hash, password_salt, is_admin, is_active
-                FROM users WHERE username = %s OR email = %s
-            """, (username, username))
-            
-            user = cursor.fetchone()
+            with db_manager.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT id, username, email, password_hash, password_salt, is_admin, is_active
+                    FROM users WHERE username = %s OR email = %s
+                """, (username, username))
+                
+                user = cursor.fetchone()
             
             if not user:
-                conn.close()
                 return jsonify({"error": "Tài khoản không tồn tại"}), 401
             
             user_id, username, email, stored_hash, salt, is_admin, is_active = user
             
             if not is_active:
-                conn.close()
                 return jsonify({"error": "Tài khoản đã bị vô hiệu hóa"}), 403
             
-            # Xác thực mật khẩu
+            # Xác thực mật khẩu (không giữ connection trong lúc hash)
             if not verify_password(password, salt, stored_hash):
-                conn.close()
                 return jsonify({"error": "Mật khẩu không đúng"}), 401
             
-            # Cập nhật last_login
-            cursor.execute("UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = %s", (user_id,))
-            
             # Tạo JWT token
             token = generate_jwt_token(user_id, username, is_admin)
             
@@ -315,13 +336,16 @@ def register_auth_routes(app):
             session_token = secrets.token_hex(32)
             expires_at = datetime.utcnow() + timedelta(hours=JWT_EXPIRE_HOURS)
             
-            cursor.execute("""
-                INSERT INTO user_sessions (user_id, session_token, ip_address, user_agent, expires_at)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (user_id, session_token, request.remote_addr, request.user_agent.string, expires_at))
-            
-            conn.commit()
-            conn.close()
+            with db_manager.connection() as conn:
+                cursor = conn.cursor()
+                
+                # Cập nhật last_login
+                cursor.execute("UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = %s", (user_id,))
+                
+                cursor.execute("""
+                    INSERT INTO user_sessions (user_id, session_token, ip_address, user_agent, expires_at)
+                    VALUES (%s, %s, %s, %s, %s)
+                """, (user_id, session_token, request.remote_addr, request.user_agent.string, expires_at))
             
             logger.info(f"✅ User đăng nhập: {username}")
             
@@ -361,17 +385,13 @@ def register_auth_routes(app):
             token = request.headers.get('Authorization', '').replace('Bearer ', '')
             
             # Vô hiệu hóa session trong database
-            conn = get_database_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                UPDATE user_sessions 
-                SET is_valid = FALSE 
-                WHERE session_token = %s AND is_valid = TRUE
-            """, (token,))
-            
-            conn.commit()
-            conn.close()
+            with db_manager.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    UPDATE user_sessions 
+                    SET is_valid = FALSE 
+                    WHERE session_token = %s AND is_valid = TRUE
+                """, (token,))
             
             response = jsonify({"success": True, "message": "Đã đăng xuất"})
             response.delete_cookie('access_token')
@@ -387,18 +407,16 @@ def register_auth_routes(app):
     def get_current_user():
         """Lấy thông tin user hiện tại"""
         try:
-            conn = get_database_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT id, username, email, binance_api_key, binance_api_secret,
-                       telegram_bot_token, telegram_chat_id, is_admin, is_active,
-                       created_at, last_login
-                FROM users WHERE id = %s
-            """, (request.user_id,))
-            
-            user = cursor.fetchone()
-            conn.close()
+            with db_manager.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT id, username, email, binance_api_key, binance_api_secret,
+                           telegram_bot_token, telegram_chat_id, is_admin, is_active,
+                           created_at, last_login
+                    FROM users WHERE id = %s
+                """, (request.user_id,))
+                
+                user = cursor.fetchone()
             
             if not user:
                 return jsonify({"error": "User không tồn tại"}), 404
@@ -430,43 +448,41 @@ def register_auth_routes(app):
         try:
             data = request.get_json()
             
-            conn = get_database_connection()
-            cursor = conn.cursor()
-            
-            # Lấy user hiện tại để merge
-            cursor.execute("""
-                SELECT binance_api_key, binance_api_secret, telegram_bot_token, telegram_chat_id
-                FROM users WHERE id = %s
-            """, (request.user_id,))
-            
-            current = cursor.fetchone()
-            current_data = {
-                'binance_api_key': current[0] if current else None,
-                'binance_api_secret': current[1] if current else None,
-                'telegram_bot_token': current[2] if current else None,
-                'telegram_chat_id': current[3] if current else None
-            }
-            
-            # Merge với dữ liệu mới
-            update_data = {**current_data, **data}
-            
-            # Cập nhật
-            cursor.execute("""
-                UPDATE users 
-                SET binance_api_key = %s, binance_api_secret = %s,
-                    telegram_bot_token = %s, telegram_chat_id = %s,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s
-            """, (
-                update_data.get('binance_api_key'),
-                update_data.get('binance_api_secret'),
-                update_data.get('telegram_bot_token'),
-                update_data.get('telegram_chat_id'),
-                request.user_id
-            ))
-            
-            conn.commit()
-            conn.close()
+            with db_manager.connection() as conn:
+                cursor = conn.cursor()
+                
+                # Lấy user hiện tại để merge (khóa dòng tới khi commit)
+                cursor.execute("""
+                    SELECT binance_api_key, binance_api_secret, telegram_bot_token, telegram_chat_id
+                    FROM users WHERE id = %s
+                    FOR UPDATE
+                """, (request.user_id,))
+                
+                current = cursor.fetchone()
+                current_data = {
+                    'binance_api_key': current[0] if current else None,
+                    'binance_api_secret': current[1] if current else None,
+                    'telegram_bot_token': current[2] if current else None,
+                    'telegram_chat_id': current[3] if current else None
+                }
+                
+                # Merge với dữ liệu mới
+                update_data = {**current_data, **data}
+                
+                # Cập nhật
+                cursor.execute("""
+                    UPDATE users 
+                    SET binance_api_key = %s, binance_api_secret = %s,
+                        telegram_bot_token = %s, telegram_chat_id = %s,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = %s
+                """, (
+                    update_data.get('binance_api_key'),
+                    update_data.get('binance_api_secret'),
+                    update_data.get('telegram_bot_token'),
+                    update_data.get('telegram_chat_id'),
+                    request.user_id
+                ))
             
             logger.info(f"✅ User {request.username} đã cập nhật API keys")
             
@@ -491,38 +507,39 @@ def register_auth_routes(app):
             if len(new_password) < 6:
                 return jsonify({"error": "Mật khẩu mới phải có ít nhất 6 ký tự"}), 400
             
-            conn = get_database_connection()
-            cursor = conn.cursor()
-            
             # Lấy thông tin mật khẩu hiện tại
-            cursor.execute("""
-                SELECT password_hash, password_salt FROM users WHERE id = %s
-            """, (request.user_id,))
+            with db_manager.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT password_hash, password_salt FROM users WHERE id = %s
+                """, (request.user_id,))
+                
+                result = cursor.fetchone()
             
-            result = cursor.fetchone()
             if not result:
-                conn.close()
                 return jsonify({"error": "User không tồn tại"}), 404
             
             stored_hash, salt = result
             
             # Xác thực mật khẩu hiện tại
             if not verify_password(current_password, salt, stored_hash):
-                conn.close()
                 return jsonify({"error": "Mật khẩu hiện tại không đúng"}), 401
             
             # Hash mật khẩu mới
             new_salt, new_hash = hash_password(new_password)
             
-            # Cập nhật
-            cursor.execute("""
-                UPDATE users 
-                SET password_hash = %s, password_salt = %s, updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s
-            """, (new_hash, new_salt, request.user_id))
+            # Cập nhật (chỉ khi mật khẩu chưa bị đổi giữa chừng)
+            with db_manager.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    UPDATE users 
+                    SET password_hash = %s, password_salt = %s, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = %s AND password_hash = %s
+                """, (new_hash, new_salt, request.user_id, stored_hash))
+                changed = cursor.rowcount
             
-            conn.commit()
-            conn.close()
+            if not changed:
+                return jsonify({"error": "Mật khẩu đã bị thay đổi, vui lòng thử lại"}), 409
             
             logger.info(f"✅ User {request.username} đã đổi mật khẩu")
             
@@ -544,24 +561,21 @@ def register_user_bot_routes(app, bot_manager):
     def get_user_bots():
         """Lấy danh sách bot của user"""
         try:
-            conn = get_database_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT 
-                    bot_id, bot_mode, bot_type, symbol, leverage, percent,
-                    tp, sl, roi_trigger, pyramiding_n, pyramiding_x,
-                    dynamic_strategy, static_entry_mode, reverse_on_stop,
-                    status, created_at, updated_at
-                FROM bot_configs 
-                WHERE user_id = %s AND deleted_at IS NULL
-                ORDER BY created_at DESC
-            """, (request.user_id,))
-            
-            columns = [desc[0] for desc in cursor.description]
-            bots = [dict(zip(columns, row)) for row in cursor.fetchall()]
-            
-            conn.close()
+            with db_manager.read_connection(max_staleness=0) as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT 
+                        bot_id, bot_mode, bot_type, symbol, leverage, percent,
+                        tp, sl, roi_trigger, pyramiding_n, pyramiding_x,
+                        dynamic_strategy, static_entry_mode, reverse_on_stop,
+                        status, created_at, updated_at
+                    FROM bot_configs 
+                    WHERE user_id = %s AND deleted_at IS NULL
+                    ORDER BY created_at DESC
+                """, (request.user_id,))
+                
+                columns = [desc[0] for desc in cursor.description]
+                bots = [dict(zip(columns, row)) for row in cursor.fetchall()]
             
             return jsonify({"bots": bots})
             
@@ -577,16 +591,14 @@ def register_user_bot_routes(app, bot_manager):
             data = request.get_json()
             
             # Lấy API keys của user
-            conn = get_database_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT binance_api_key, binance_api_secret, telegram_bot_token, telegram_chat_id
-                FROM users WHERE id = %s
-            """, (request.user_id,))
-            
-            user_keys = cursor.fetchone()
-            conn.close()
+            with db_manager.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT binance_api_key, binance_api_secret, telegram_bot_token, telegram_chat_id
+                    FROM users WHERE id = %s
+                """, (request.user_id,))
+                
+                user_keys = cursor.fetchone()
             
             if not user_keys or not user_keys[0] or not user_keys[1]:
                 return jsonify({
@@ -613,16 +625,14 @@ def register_user_bot_routes(app, bot_manager):
     def get_user_balance():
         """Lấy số dư của user"""
         try:
-            conn = get_database_connection()
-            cursor = conn.cursor()
-            
             # Lấy API keys của user
-            cursor.execute("""
-                SELECT binance_api_key, binance_api_secret FROM users WHERE id = %s
-            """, (request.user_id,))
-            
-            user_keys = cursor.fetchone()
-            conn.close()
+            with db_manager.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT binance_api_key, binance_api_secret FROM users WHERE id = %s
+                """, (request.user_id,))
+                
+                user_keys = cursor.fetchone()
             
             if not user_keys or not user_keys[0] or not user_keys[1]:
                 return jsonify({
@@ -669,23 +679,20 @@ def register_user_bot_routes(app, bot_manager):
     def get_user_positions():
         """Lấy vị thế của user"""
         try:
-            conn = get_database_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT 
-                    bp.*,
-                    bc.bot_mode, bc.bot_type, bc.leverage, bc.percent
-                FROM bot_positions bp
-                JOIN bot_configs bc ON bp.bot_id = bc.bot_id
-                WHERE bc.user_id = %s AND bp.status = 'open'
-                ORDER BY bp.last_update DESC
-            """, (request.user_id,))
-            
-            columns = [desc[0] for desc in cursor.description]
-            positions = [dict(zip(columns, row)) for row in cursor.fetchall()]
-            
-            conn.close()
+            with db_manager.read_connection(max_staleness=5) as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT 
+                        bp.*,
+                        bc.bot_mode, bc.bot_type, bc.leverage, bc.percent
+                    FROM bot_positions bp
+                    JOIN bot_configs bc ON bp.bot_id = bc.bot_id
+                    WHERE bc.user_id = %s AND bp.status = 'open'
+                    ORDER BY bp.last_update DESC
+                """, (request.user_id,))
+                
+                columns = [desc[0] for desc in cursor.description]
+                positions = [dict(zip(columns, row)) for row in cursor.fetchall()]
             
             return jsonify({"positions": positions})
             
@@ -698,40 +705,42 @@ def register_user_bot_routes(app, bot_manager):
     def get_user_statistics():
         """Lấy thống kê của user"""
         try:
-            conn = get_database_connection()
-            cursor = conn.cursor()
-            
-            # Thống kê từ bot_statistics
-            cursor.execute("""
-                SELECT 
-                    SUM(bs.total_trades) as total_trades,
-                    SUM(bs.winning_trades) as winning_trades,
-                    SUM(bs.losing_trades) as losing_trades,
-                    SUM(bs.total_pnl) as total_pnl,
-                    COUNT(DISTINCT bc.bot_id) as total_bots
-                FROM bot_statistics bs
-                JOIN bot_configs bc ON bs.bot_id = bc.bot_id
-                WHERE bc.user_id = %s
-            """, (request.user_id,))
-            
-            stats = cursor.fetchone()
-            
-            # Thống kê ngày
-            cursor.execute("""
-                SELECT 
-                    DATE(created_at) as date,
-                    SUM(pnl) as daily_pnl,
-                    COUNT(*) as daily_trades
-                FROM trade_history th
-                JOIN bot_configs bc ON th.bot_id = bc.bot_id
-                WHERE bc.user_id = %s AND created_at >= CURRENT_DATE - INTERVAL '30 days'
-                GROUP BY DATE(created_at)
-                ORDER BY date DESC
-            """, (request.user_id,))
-            
-            daily_stats = cursor.fetchall()
-            
-            conn.close()
+            with db_manager.read_connection(max_staleness=30) as conn:
+                cursor = conn.cursor()
+                
+                # Thống kê từ bot_statistics
+                cursor.execute("""
+                    SELECT 
+                        SUM(bs.total_trades) as total_trades,
+                        SUM(bs.winning_trades) as winning_trades,
+                        SUM(bs.losing_trades) as losing_trades,
+                        SUM(bs.total_pnl) as total_pnl,
+                        MAX(bs.max_drawdown) as max_drawdown,
+                        COUNT(DISTINCT bc.bot_id) as total_bots
+                    FROM bot_statistics bs
+                    JOIN bot_configs bc ON bs.bot_id = bc.bot_id
+                    WHERE bc.user_id = %s
+                """, (request.user_id,))
+                
+                stats = cursor.fetchone()
+                
+                # Thống kê ngày (từ daily_pnl_rollup, không quét trade_history)
+                cursor.execute("""
+                    SELECT 
+                        r.day as date,
+                        SUM(r.pnl) as daily_pnl,
+                        SUM(r.trades) as daily_trades,
+                        SUM(r.wins) as daily_wins,
+                        SUM(r.losses) as daily_losses,
+                        SUM(r.volume) as daily_volume
+                    FROM daily_pnl_rollup r
+                    JOIN bot_configs bc ON r.bot_id = bc.bot_id
+                    WHERE bc.user_id = %s AND r.day >= CURRENT_DATE - 30
+                    GROUP BY r.day
+                    ORDER BY date DESC
+                """, (request.user_id,))
+                
+                daily_stats = cursor.fetchall()
             
             return jsonify({
                 "statistics": {
@@ -739,14 +748,18 @@ def register_user_bot_routes(app, bot_manager):
                     "winning_trades": stats[1] or 0,
                     "losing_trades": stats[2] or 0,
                     "total_pnl": float(stats[3] or 0),
-                    "total_bots": stats[4] or 0,
+                    "max_drawdown": float(stats[4] or 0),
+                    "total_bots": stats[5] or 0,
                     "win_rate": (stats[1] / stats[0] * 100) if stats[0] else 0
                 },
                 "daily_stats": [
                     {
                         "date": row[0].isoformat(),
                         "daily_pnl": float(row[1] or 0),
-                        "daily_trades": row[2] or 0
+                        "daily_trades": row[2] or 0,
+                        "daily_wins": row[3] or 0,
+                        "daily_losses": row[4] or 0,
+                        "daily_volume": float(row[5] or 0)
                     } for row in daily_stats
                 ]
             })
@@ -755,6 +768,12 @@ def register_user_bot_routes(app, bot_manager):
             logger.error(f"❌ Lỗi lấy statistics của user: {str(e)}")
             return jsonify({"error": str(e)}), 500
 
+    @app.route('/api/user/export/<kind>', methods=['GET'])
+    @login_required
+    def export_user_history(kind):
+        """Export trade/position history của user (CSV hoặc NDJSON, stream)"""
+        return export_response(kind, user_id=request.user_id)
+
 # ================== ADMIN ENDPOINTS ==================
 def register_admin_routes(app):
     """Đăng ký route admin"""
@@ -764,22 +783,19 @@ def register_admin_routes(app):
     def get_all_users():
         """Lấy danh sách tất cả users (admin only)"""
         try:
-            conn = get_database_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT 
-                    id, username, email, is_admin, is_active,
-                    created_at, last_login,
-                    (SELECT COUNT(*) FROM bot_configs WHERE user_id = users.id) as bot_count
-                FROM users
-                ORDER BY created_at DESC
-            """)
-            
-            columns = [desc[0] for desc in cursor.description]
-            users = [dict(zip(columns, row)) for row in cursor.fetchall()]
-            
-            conn.close()
+            with db_manager.read_connection(max_staleness=0) as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT 
+                        id, username, email, is_admin, is_active,
+                        created_at, last_login,
+                        (SELECT COUNT(*) FROM bot_configs WHERE user_id = users.id) as bot_count
+                    FROM users
+                    ORDER BY created_at DESC
+                """)
+                
+                columns = [desc[0] for desc in cursor.description]
+                users = [dict(zip(columns, row)) for row in cursor.fetchall()]
             
             return jsonify({"users": users})
             
@@ -787,32 +803,32 @@ def register_admin_routes(app):
             logger.error(f"❌ Lỗi lấy users (admin): {str(e)}")
             return jsonify({"error": str(e)}), 500
     
+    @app.route('/api/admin/export/<kind>', methods=['GET'])
+    @admin_required
+    def export_history_admin(kind):
+        """Export trade/position history của mọi user hoặc một user (query user_id) (admin only)"""
+        return export_response(kind, user_id=request.args.get("user_id", type=int))
+    
     @app.route('/api/admin/users/<int:user_id>/toggle', methods=['PUT'])
     @admin_required
     def toggle_user_status(user_id):
         """Bật/tắt user (admin only)"""
         try:
-            conn = get_database_connection()
-            cursor = conn.cursor()
-            
-            # Lấy trạng thái hiện tại
-            cursor.execute("SELECT is_active FROM users WHERE id = %s", (user_id,))
-            result = cursor.fetchone()
+            with db_manager.connection() as conn:
+                cursor = conn.cursor()
+                
+                # Đảo trạng thái trong một câu lệnh (không đọc rồi ghi)
+                cursor.execute("""
+                    UPDATE users SET is_active = NOT is_active, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = %s
+                    RETURNING is_active
+                """, (user_id,))
+                result = cursor.fetchone()
             
             if not result:
-                conn.close()
                 return jsonify({"error": "User không tồn tại"}), 404
             
-            new_status = not result[0]
-            
-            # Cập nhật
-            cursor.execute("""
-                UPDATE users SET is_active = %s, updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s
-            """, (new_status, user_id))
-            
-            conn.commit()
-            conn.close()
+            new_status = result[0]
             
             status_text = "kích hoạt" if new_status else "vô hiệu hóa"
             logger.info(f"✅ Admin {request.username} đã {status_text} user #{user_id}")
@@ -832,46 +848,46 @@ def register_admin_routes(app):
     def get_system_stats():
         """Thống kê hệ thống (admin only)"""
         try:
-            conn = get_database_connection()
-            cursor = conn.cursor()
-            
-            # Tổng số users
-            cursor.execute("SELECT COUNT(*) FROM users")
-            total_users = cursor.fetchone()[0]
-            
-            # Users active
-            cursor.execute("SELECT COUNT(*) FROM users WHERE is_active = TRUE")
-            active_users = cursor.fetchone()[0]
-            
-            # Tổng số bots
-            cursor.execute("SELECT COUNT(*) FROM bot_configs WHERE deleted_at IS NULL")
-            total_bots = cursor.fetchone()[0]
-            
-            # Bots running
-            cursor.execute("SELECT COUNT(*) FROM bot_configs WHERE status = 'running' AND deleted_at IS NULL")
-            running_bots = cursor.fetchone()[0]
-            
-            # Tổng PnL
-            cursor.execute("SELECT SUM(total_pnl) FROM bot_statistics")
-            total_pnl = cursor.fetchone()[0] or 0
-            
-            # Thống kê theo ngày
-            cursor.execute("""
-                SELECT 
-                    DATE(created_at) as date,
-                    COUNT(DISTINCT user_id) as active_users,
-                    COUNT(DISTINCT bot_id) as active_bots,
-                    SUM(pnl) as daily_pnl
-                FROM trade_history th
-                JOIN bot_configs bc ON th.bot_id = bc.bot_id
-                WHERE created_at >= CURRENT_DATE - INTERVAL '7 days'
-                GROUP BY DATE(created_at)
-                ORDER BY date DESC
-            """)
-            
-            daily_stats = cursor.fetchall()
-            
-            conn.close()
+            with db_manager.read_connection(max_staleness=60) as conn:
+                cursor = conn.cursor()
+                
+                # Tổng số users
+                cursor.execute("SELECT COUNT(*) FROM users")
+                total_users = cursor.fetchone()[0]
+                
+                # Users active
+                cursor.execute("SELECT COUNT(*) FROM users WHERE is_active = TRUE")
+                active_users = cursor.fetchone()[0]
+                
+                # Tổng số bots
+                cursor.execute("SELECT COUNT(*) FROM bot_configs WHERE deleted_at IS NULL")
+                total_bots = cursor.fetchone()[0]
+                
+                # Bots running
+                cursor.execute("SELECT COUNT(*) FROM bot_configs WHERE status = 'running' AND deleted_at IS NULL")
+                running_bots = cursor.fetchone()[0]
+                
+                # Tổng PnL
+                cursor.execute("SELECT SUM(total_pnl) FROM bot_statistics")
+                total_pnl = cursor.fetchone()[0] or 0
+                
+                # Thống kê theo ngày (từ daily_pnl_rollup)
+                cursor.execute("""
+                    SELECT 
+                        r.day as date,
+                        COUNT(DISTINCT bc.user_id) as active_users,
+                        COUNT(DISTINCT r.bot_id) as active_bots,
+                        SUM(r.pnl) as daily_pnl,
+                        SUM(r.trades) as daily_trades,
+                        SUM(r.volume) as daily_volume
+                    FROM daily_pnl_rollup r
+                    JOIN bot_configs bc ON r.bot_id = bc.bot_id
+                    WHERE r.day >= CURRENT_DATE - 7
+                    GROUP BY r.day
+                    ORDER BY date DESC
+                """)
+                
+                daily_stats = cursor.fetchall()
             
             return jsonify({
                 "system_stats": {
@@ -886,7 +902,9 @@ def register_admin_routes(app):
                         "date": row[0].isoformat(),
                         "active_users": row[1] or 0,
                         "active_bots": row[2] or 0,
-                        "daily_pnl": float(row[3] or 0)
+                        "daily_pnl": float(row[3] or 0),
+                        "daily_trades": row[4] or 0,
+                        "daily_volume": float(row[5] or 0)
                     } for row in daily_stats
                 ]
             })
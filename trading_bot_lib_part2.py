@@ -2,10 +2,13 @@
 # PHẦN 2: THƯ VIỆN BASEBOT VỚI DATABASE TÍCH HỢP
 from trading_bot_lib_part1 import (
     logger, get_all_usdt_pairs, get_max_leverage, get_step_size,
-    set_leverage, get_total_and_available_balance, get_margin_safety_info,
-    place_order, cancel_all_orders, get_current_price, get_positions,
+    set_leverage, get_total_and_available_balance, api_executor,
+    place_tracked_order, place_tracked_batch, cancel_all_orders, get_current_price, get_positions,
+    get_user_data_stream, get_portfolio_aggregator, get_margin_guardian, timer_wheel,
+    persistence_worker, state_repository, PositionOpened, PositionUpdated, PositionClosed, PositionDeleted,
+    TradeRecorded, StatsDelta,
     CoinManager, BotExecutionCoordinator, SmartCoinFinder, WebSocketManager,
-    send_telegram, get_top_volume_symbols, get_high_volatility_symbols,
+    send_telegram_async, get_top_volume_symbols, get_high_volatility_symbols,
     db_manager
 )
 
@@ -15,6 +18,97 @@ import math
 import random
 from datetime import datetime
 from collections import defaultdict
+from typing import Dict, Optional
+
+# ========== TRẠNG THÁI SYMBOL ==========
+class SymbolState:
+    """Trạng thái vị thế của một symbol trong bot (thay cho dict 20 khóa)"""
+
+    __slots__ = (
+        'status', 'side', 'qty', 'entry', 'current_price', 'position_open',
+        'last_trade_time', 'last_close_time', 'entry_base', 'average_down_count',
+        'last_average_down_time', 'high_water_mark_roi', 'roi_check_activated',
+        'close_attempted', 'last_close_attempt', 'last_position_check',
+        'pyramiding_count', 'next_pyramiding_roi', 'last_pyramiding_time',
+        'pyramiding_base_roi',
+    )
+
+    def __init__(self, next_pyramiding_roi: float = 0.0):
+        self.status: str = 'waiting'
+        self.side: str = ''
+        self.qty: float = 0.0                 # có dấu: BUY(+) / SELL(-)
+        self.entry: float = 0.0
+        self.current_price: float = 0.0
+        self.position_open: bool = False
+        self.last_trade_time: float = 0.0
+        self.last_close_time: float = 0.0
+        self.entry_base: float = 0.0
+        self.average_down_count: int = 0
+        self.last_average_down_time: float = 0.0
+        self.high_water_mark_roi: float = 0.0
+        self.roi_check_activated: bool = False
+        self.close_attempted: bool = False
+        self.last_close_attempt: float = 0.0
+        self.last_position_check: float = 0.0
+        self.pyramiding_count: int = 0
+        self.next_pyramiding_roi: float = next_pyramiding_roi
+        self.last_pyramiding_time: float = 0.0
+        self.pyramiding_base_roi: float = 0.0
+
+    def update(self, **fields):
+        """Cập nhật nhiều trường cùng lúc"""
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def set_open(self, side: str, quantity: float, entry: float):
+        """Đánh dấu vị thế đang mở (quantity dương, tự gán dấu theo side)"""
+        self.position_open = True
+        self.status = 'open'
+        self.side = side
+        self.qty = abs(quantity) if side == 'BUY' else -abs(quantity)
+        self.entry = float(entry or 0)
+
+    def reset_position(self, next_pyramiding_roi: float = 0.0):
+        """Reset thông tin vị thế, giữ lại các mốc thời gian giao dịch"""
+        self.position_open = False
+        self.status = 'waiting'
+        self.side = ''
+        self.qty = 0.0
+        self.entry = 0.0
+        self.close_attempted = False
+        self.last_close_attempt = 0.0
+        self.entry_base = 0.0
+        self.average_down_count = 0
+        self.high_water_mark_roi = 0.0
+        self.roi_check_activated = False
+        self.pyramiding_count = 0
+        self.next_pyramiding_roi = next_pyramiding_roi
+        self.last_pyramiding_time = 0.0
+        self.pyramiding_base_roi = 0.0
+
+    @property
+    def abs_qty(self) -> float:
+        return abs(self.qty)
+
+    def pnl(self, price: float, qty: Optional[float] = None) -> float:
+        """PnL tại giá price (mặc định trên toàn bộ khối lượng đang giữ)"""
+        qty = abs(self.qty) if qty is None else abs(qty)
+        if self.side == 'BUY':
+            return (price - self.entry) * qty
+        return (self.entry - price) * qty
+
+    def invested(self, lev) -> float:
+        """Vốn ký quỹ đã bỏ vào vị thế"""
+        if not lev:
+            return 0.0
+        return self.entry * abs(self.qty) / lev
+
+    def roi(self, price: float, lev) -> Optional[float]:
+        """ROI (%) tại giá price, None nếu không tính được"""
+        invested = self.invested(lev)
+        if invested <= 0:
+            return None
+        return (self.pnl(price) / invested) * 100
 
 # ========== LỚP BOT CƠ SỞ VỚI DATABASE ==========
 class BaseBot:
@@ -24,7 +118,8 @@ class BaseBot:
                  telegram_bot_token, telegram_chat_id, strategy_name, config_key=None, bot_id=None,
                  coin_manager=None, symbol_locks=None, max_coins=1, bot_coordinator=None,
                  pyramiding_n=0, pyramiding_x=0, bot_type="balance_protection",  
-                 dynamic_strategy="volume", reverse_on_stop=False, static_entry_mode="signal"):
+                 dynamic_strategy="volume", reverse_on_stop=False, static_entry_mode="signal",
+                 positions_snapshot=None, persist_config=True):
         
         self.bot_type = bot_type
         self.dynamic_strategy = dynamic_strategy
@@ -33,7 +128,7 @@ class BaseBot:
         
         self.max_coins = 1
         self.active_symbols = []
-        self.symbol_data = {}
+        self.symbol_data: Dict[str, SymbolState] = {}
         self.symbol = symbol.upper() if symbol else None
 
         self.lev = lev
@@ -61,9 +156,10 @@ class BaseBot:
         self.last_trade_completion_time = 0
         self.trade_cooldown = 30
 
-        self.last_global_position_check = 0
         self.last_error_log_time = 0
         self.global_position_check_interval = 30
+        self.position_check_interval = 30
+        self._symbol_timers = {}
 
         self.global_long_count = 0
         self.global_short_count = 0
@@ -74,8 +170,6 @@ class BaseBot:
         self.next_global_side = None
 
         self.margin_safety_threshold = 1.15
-        self.margin_safety_interval = 10
-        self.last_margin_safety_check = 0
 
         self.volume_imbalance_threshold = 0.1
 
@@ -92,13 +186,30 @@ class BaseBot:
 
         self.bot_coordinator = bot_coordinator or BotExecutionCoordinator()
 
-        self._save_bot_config_to_db()
-        self._restore_positions_from_exchange_and_db()
+        # Luồng user-data dùng chung theo tài khoản, cung cấp báo cáo khớp lệnh cho order_tracker
+        get_user_data_stream(api_key, api_secret)
+        self.portfolio = get_portfolio_aggregator(api_key, api_secret)
+        if self.portfolio is not None:
+            self.ws_manager.add_price_listener(self.portfolio.on_price)
+
+        # Bảo vệ ký quỹ dùng chung theo tài khoản thay cho việc mỗi bot tự hỏi /account
+        self.margin_guardian = get_margin_guardian(api_key, api_secret, self.margin_safety_threshold)
+        if self.margin_guardian is not None:
+            self.ws_manager.add_price_listener(self.margin_guardian.on_price)
+            self.margin_guardian.add_protective_action(self._on_margin_breach)
 
+        # Khi khôi phục hàng loạt: cấu hình đã có trong DB và vị thế lấy từ snapshot dùng chung
+        if persist_config:
+            self._save_bot_config_to_db()
+        self._restore_positions_from_exchange_and_db(positions_snapshot)
 
-        if symbol and not self.coin_finder.has_existing_position(symbol):
+        if symbol and not self.coin_finder.has_existing_position(symbol, positions_snapshot):
             self._add_symbol(symbol)
         
+        # Việc định kỳ (vị thế toàn cục, đối soát từng symbol) chạy trên timer wheel dùng chung
+        self._global_timer = timer_wheel.schedule(self.global_position_check_interval, self.check_global_positions,
+                                                  name=f"{self.bot_id}:global", first_delay=0)
+
         self.thread = threading.Thread(target=self._run, daemon=True)
         self.thread.start()
 
@@ -144,35 +255,25 @@ class BaseBot:
     def _restore_positions_from_db(self):
         """Khôi phục vị thế từ database khi khởi động lại"""
         try:
-            positions = db_manager.get_open_positions(self.bot_id)
+            positions = state_repository.get_open_positions(self.bot_id)
             
             for pos in positions:
                 symbol = pos['symbol']
                 if symbol not in self.active_symbols:
                     self._add_symbol(symbol)
                 
-                self.symbol_data[symbol] = {
-                    'status': 'open',
-                    'side': pos['side'],
-                    'qty': pos['quantity'] * (1 if pos['side'] == 'BUY' else -1),
-                    'entry': pos['entry_price'],
-                    'current_price': pos['current_price'] or get_current_price(symbol),
-                    'position_open': True,
-                    'last_trade_time': time.time(),
-                    'last_close_time': 0,
-                    'entry_base': pos['entry_price'],
-                    'average_down_count': 0,
-                    'last_average_down_time': 0,
-                    'high_water_mark_roi': pos['roi'] or 0,
-                    'roi_check_activated': pos['roi'] and pos['roi'] >= self.roi_trigger if self.roi_trigger else False,
-                    'close_attempted': False,
-                    'last_close_attempt': 0,
-                    'last_position_check': time.time(),
-                    'pyramiding_count': pos['pyramiding_count'],
-                    'next_pyramiding_roi': self.pyramiding_x if self.pyramiding_enabled else 0,
-                    'last_pyramiding_time': 0,
-                    'pyramiding_base_roi': 0.0,
-                }
+                state = self._new_symbol_state()
+                state.set_open(pos['side'], pos['quantity'], pos['entry_price'])
+                state.update(
+                    current_price=pos['current_price'] or get_current_price(symbol),
+                    last_trade_time=time.time(),
+                    entry_base=pos['entry_price'],
+                    high_water_mark_roi=pos['roi'] or 0,
+                    roi_check_activated=bool(self.roi_trigger and pos['roi'] and pos['roi'] >= self.roi_trigger),
+                    last_position_check=time.time(),
+                    pyramiding_count=pos['pyramiding_count'] or 0,
+                )
+                self.symbol_data[symbol] = state
                 
                 self.coin_manager.register_coin(symbol, self.bot_id)
                 self.bot_coordinator.bot_has_coin(self.bot_id)
@@ -182,17 +283,22 @@ class BaseBot:
         except Exception as e:
             self.log(f"❌ Lỗi khôi phục vị thế từ database: {str(e)}")
     
-    def _restore_positions_from_exchange_and_db(self):
+    def _restore_positions_from_exchange_and_db(self, positions_snapshot=None, extra_symbols=()):
         """
         Khôi phục vị thế khi restart theo nguyên tắc:
         - Binance là sự thật (source of truth)
         - Nếu Binance còn vị thế => coi như bot đã mở trước đó => chỉ quản lý chốt/nhồi
         - Nếu Binance không còn => DB/ram phải về CLOSED để không bị hiểu sai
+        positions_snapshot: positionRisk đã lấy sẵn cho cả tài khoản (khôi phục hàng loạt)
+        extra_symbols: symbol không có dòng DB của bot nào nhưng được giao cho bot này quản lý
         """
         try:
             # 1) Lấy vị thế thật từ Binance (hàm get_positions nằm trong part1)
             # get_positions trả danh sách positionRisk: positionAmt, entryPrice, markPrice, symbol...
-            all_pos = get_positions(symbol=None, api_key=self.api_key, api_secret=self.api_secret) or []
+            if positions_snapshot is not None:
+                all_pos = positions_snapshot
+            else:
+                all_pos = get_positions(symbol=None, api_key=self.api_key, api_secret=self.api_secret) or []
     
             # Map các vị thế đang mở theo symbol
             open_on_binance = {}
@@ -221,42 +327,39 @@ class BaseBot:
                     continue
     
             # 2) Nếu bot là STATIC (self.symbol có giá trị) thì chỉ restore đúng symbol đó
-            # Nếu bot là DYNAMIC (self.symbol None) thì restore các symbol đang có vị thế
+            # Nếu bot là DYNAMIC (self.symbol None) thì restore các symbol DB ghi nhận là của bot này
+            db_open = state_repository.get_open_positions(self.bot_id) or []
             target_symbols = []
             if self.symbol:
                 target_symbols = [self.symbol.upper()]
             else:
-                target_symbols = list(open_on_binance.keys())
+                target_symbols = [(pos.get("symbol") or "").upper() for pos in db_open]
+                target_symbols += [sym.upper() for sym in extra_symbols if sym.upper() not in target_symbols]
     
-            # 3) Apply vào RAM + DB theo Binance
+            # 3) Apply vào RAM + DB theo Binance (ghi DB gom theo transaction ở cuối)
+            restored_rows = []
             for sym in target_symbols:
                 if sym not in open_on_binance:
                     continue
     
                 pos = open_on_binance[sym]
     
-                # đảm bảo symbol nằm trong active_symbols
+                # đảm bảo symbol nằm trong active_symbols (vị thế có sẵn nên không qua _add_symbol)
                 if sym not in self.active_symbols:
-                    self._add_symbol(sym)
-    
-                # cập nhật state RAM (symbol_data) theo format bạn đang dùng
-                # qty có dấu theo side BUY(+)/SELL(-) như code cũ của bạn
-                signed_qty = pos["quantity"] * (1 if pos["side"] == "BUY" else -1)
+                    self._track_symbol(sym)
     
-                self.symbol_data[sym] = {
-                    "status": "open",
-                    "side": pos["side"],
-                    "qty": signed_qty,
-                    "entry": pos["entry_price"],
-                    "current_price": pos["current_price"],
-                    "position_open": True,
-                    "last_trade_time": time.time(),
-                    "last_close_time": 0,
-                    "pyramiding_count": self.symbol_data.get(sym, {}).get("pyramiding_count", 0),
-                }
+                # cập nhật state RAM (symbol_data), giữ lại số lần nhồi nếu đã có
+                state = self.symbol_data.get(sym) or self._new_symbol_state()
+                state.set_open(pos["side"], pos["quantity"], pos["entry_price"])
+                state.update(
+                    current_price=pos["current_price"],
+                    last_trade_time=time.time(),
+                    last_close_time=0,
+                )
+                self.symbol_data[sym] = state
     
                 # lưu DB (để bot manager / web hiển thị đúng)
-                db_manager.save_position({
+                restored_rows.append({
                     "bot_id": self.bot_id,
                     "symbol": sym,
                     "side": pos["side"],
@@ -266,12 +369,12 @@ class BaseBot:
                     "roi": 0,                 # bạn có thể tính ROI nếu muốn
                     "tp_price": None,
                     "sl_price": None,
-                    "pyramiding_count": self.symbol_data[sym].get("pyramiding_count", 0),
+                    "pyramiding_count": state.pyramiding_count,
                     "status": "open",
                 })
     
             # 4) Reconcile ngược: DB đang open nhưng Binance không còn => đóng DB + reset RAM
-            db_open = db_manager.get_open_positions(self.bot_id) or []
+            stale_symbols = []
             for pos in db_open:
                 sym = (pos.get("symbol") or "").upper()
                 if not sym:
@@ -279,50 +382,60 @@ class BaseBot:
     
                 if sym not in open_on_binance:
                     # Binance không còn vị thế => DB phải đóng
-                    db_manager.close_position(self.bot_id, sym, reason="sync_restart_binance_no_position")
+                    stale_symbols.append(sym)
     
                     # reset RAM nếu đang giữ
-                    if sym in self.symbol_data:
-                        try:
-                            self.symbol_data[sym]["status"] = "closed"
-                            self.symbol_data[sym]["position_open"] = False
-                            self.symbol_data[sym]["qty"] = 0
-                            self.symbol_data[sym]["last_close_time"] = time.time()
-                        except Exception:
-                            pass
+                    state = self.symbol_data.get(sym)
+                    if state is not None:
+                        state.update(status="closed", position_open=False, qty=0.0, last_close_time=time.time())
+
+            if stale_symbols:
+                with db_manager.transaction() as tx:
+                    for sym in stale_symbols:
+                        db_manager.close_position(self.bot_id, sym, tx=tx)
+            if restored_rows:
+                with db_manager.transaction() as tx:
+                    for row in restored_rows:
+                        db_manager.save_position(row, tx=tx)
     
             logger.info(f"✅ Sync positions on startup: binance_open={len(open_on_binance)} | active={len(self.active_symbols)}")
     
         except Exception as e:
             logger.error(f"❌ Lỗi _restore_positions_from_exchange_and_db: {e}")
 
+    def adopt_positions(self, symbols, positions_snapshot=None):
+        """Nhận quản lý các vị thế trên sàn mà không bot nào có dòng DB (bản ghi mở vị thế bị mất)"""
+        if self.symbol or not symbols:
+            return
+        self._restore_positions_from_exchange_and_db(positions_snapshot, extra_symbols=symbols)
+        self.log(f"🚨 Nhận quản lý {len(symbols)} vị thế không có bản ghi DB: {', '.join(symbols)}")
+
     def _save_position_to_db(self, symbol, action="open"):
         """Lưu vị thế vào database"""
         if symbol not in self.symbol_data:
             return
         
-        symbol_info = self.symbol_data[symbol]
+        state = self.symbol_data[symbol]
         
-        if action == "open" and symbol_info['position_open']:
+        if action == "open" and state.position_open:
             position_data = {
                 'bot_id': self.bot_id,
                 'symbol': symbol,
-                'side': symbol_info['side'],
-                'entry_price': symbol_info['entry'],
-                'quantity': abs(symbol_info['qty']),
-                'current_price': symbol_info.get('current_price', 0),
+                'side': state.side,
+                'entry_price': state.entry,
+                'quantity': state.abs_qty,
+                'current_price': state.current_price,
                 'roi': 0,
-                'tp_price': symbol_info['entry'] * (1 + self.tp/100) if symbol_info['side'] == 'BUY' else symbol_info['entry'] * (1 - self.tp/100),
-                'sl_price': symbol_info['entry'] * (1 - self.sl/100) if symbol_info['side'] == 'BUY' else symbol_info['entry'] * (1 + self.sl/100),
-                'pyramiding_count': symbol_info.get('pyramiding_count', 0),
+                'tp_price': state.entry * (1 + self.tp/100) if state.side == 'BUY' else state.entry * (1 - self.tp/100),
+                'sl_price': state.entry * (1 - self.sl/100) if state.side == 'BUY' else state.entry * (1 + self.sl/100),
+                'pyramiding_count': state.pyramiding_count,
                 'status': 'open'
             }
             
-            if db_manager.save_position(position_data):
-                logger.debug(f"✅ Đã lưu vị thế {symbol} vào database")
+            persistence_worker.submit(PositionOpened(self.bot_id, symbol, position_data))
     
-    def _save_trade_history(self, symbol, side, price, quantity, pnl=None, roi=None, reason=""):
-        """Lưu lịch sử giao dịch vào database"""
+    def _trade_events(self, symbol, side, price, quantity, pnl=None, roi=None, reason=""):
+        """Sự kiện ghi lịch sử giao dịch (kèm thống kê nếu có PnL)"""
         trade_data = {
             'bot_id': self.bot_id,
             'symbol': symbol,
@@ -334,55 +447,34 @@ class BaseBot:
             'reason': reason
         }
         
-        if db_manager.save_trade_history(trade_data):
-            if pnl is not None:
-                is_win = pnl > 0
-                db_manager.update_statistics(self.bot_id, pnl, is_win)
-            
-            logger.debug(f"✅ Đã lưu lịch sử giao dịch {symbol} vào database")
-    
-    def _update_position_in_db(self, symbol, updates):
-        """Cập nhật thông tin vị thế trong database"""
+        events = [TradeRecorded(self.bot_id, symbol, trade_data)]
+        if pnl is not None:
+            events.append(StatsDelta(self.bot_id, pnl, pnl > 0))
+        return events
+
+    def _save_trade_history(self, symbol, side, price, quantity, pnl=None, roi=None, reason=""):
+        """Lưu lịch sử giao dịch vào database (ghi nền)"""
+        persistence_worker.submit(*self._trade_events(symbol, side, price, quantity, pnl, roi, reason))
+
+    def _position_update_event(self, symbol):
+        """Ảnh chụp vị thế hiện tại để ghi nền (None nếu không có vị thế)"""
         try:
-            if symbol not in self.symbol_data or not self.symbol_data[symbol]['position_open']:
-                return
-            
-            symbol_info = self.symbol_data[symbol]
+            state = self.symbol_data.get(symbol)
+            if state is None or not state.position_open:
+                return None
             
             current_price = self.get_current_price(symbol)
-            if current_price > 0:
-                if symbol_info['side'] == "BUY":
-                    profit = (current_price - symbol_info['entry']) * abs(symbol_info['qty'])
-                else:
-                    profit = (symbol_info['entry'] - current_price) * abs(symbol_info['qty'])
-                    
-                invested = symbol_info['entry'] * abs(symbol_info['qty']) / self.lev
-                if invested > 0:
-                    current_roi = (profit / invested) * 100
-                else:
-                    current_roi = 0
-            else:
-                current_roi = 0
-            
-            query = """
-            UPDATE bot_positions 
-            SET current_price = %s, 
-                roi = %s,
-                pyramiding_count = %s,
-                last_update = CURRENT_TIMESTAMP
-            WHERE bot_id = %s AND symbol = %s AND status = 'open'
-            """
-            
-            db_manager.execute_query(query, (
-                current_price,
-                current_roi,
-                symbol_info.get('pyramiding_count', 0),
-                self.bot_id,
-                symbol
-            ))
+            current_roi = (state.roi(current_price, self.lev) or 0) if current_price > 0 else 0
+            return PositionUpdated(self.bot_id, symbol, current_price, current_roi, state.pyramiding_count,
+                                   state.abs_qty, state.entry)
             
         except Exception as e:
             logger.error(f"❌ Lỗi cập nhật vị thế {symbol} trong database: {str(e)}")
+            return None
+    
+    def _update_position_in_db(self, symbol, updates):
+        """Cập nhật thông tin vị thế trong database (ghi nền)"""
+        persistence_worker.submit(self._position_update_event(symbol))
     
     # ========== CÁC HÀM CHUNG ==========
     
@@ -390,18 +482,6 @@ class BaseBot:
         """Vòng lặp chính với database"""
         while not self._stop:
             try:
-                current_time = time.time()
-
-                if current_time - self.last_margin_safety_check > self.margin_safety_interval:
-                    self.last_margin_safety_check = current_time
-                    if self._check_margin_safety():
-                        time.sleep(5)
-                        continue
-                
-                if current_time - self.last_global_position_check > 30:
-                    self.check_global_positions()
-                    self.last_global_position_check = current_time
-                
                 if not self.active_symbols:
                     if self.symbol:
                         if self.symbol not in self.active_symbols:
@@ -433,7 +513,8 @@ class BaseBot:
                         time.sleep(2)
                 
                 for symbol in self.active_symbols.copy():
-                    position_opened = self._process_single_symbol(symbol)
+                    with self.execution_lock:
+                        position_opened = self._process_single_symbol(symbol)
                     
                     if position_opened:
                         self.log(f"🎯 Đã vào lệnh thành công {symbol}, chuyển quyền tìm coin...")
@@ -453,16 +534,10 @@ class BaseBot:
     def _process_single_symbol(self, symbol):
         """Xử lý một symbol với cập nhật database"""
         try:
-            symbol_info = self.symbol_data[symbol]
+            state = self.symbol_data[symbol]
             current_time = time.time()
             
-            if current_time - symbol_info.get('last_position_check', 0) > 30:
-                self._check_symbol_position(symbol)
-                symbol_info['last_position_check'] = current_time
-                
-                self._update_position_in_db(symbol, {})
-            
-            if symbol_info['position_open']:
+            if state.position_open:
                 if self.symbol:
                     self._check_symbol_tp_sl(symbol)
                     
@@ -488,8 +563,8 @@ class BaseBot:
                     
                 return False
             else:
-                if (current_time - symbol_info['last_trade_time'] > 30 and 
-                    current_time - symbol_info['last_close_time'] > 30):
+                if (current_time - state.last_trade_time > 30 and 
+                    current_time - state.last_close_time > 30):
                     
                     if self.symbol:
                         return self._process_static_entry(symbol)
@@ -519,10 +594,9 @@ class BaseBot:
                 target_side = entry_signal
             
             if target_side in ["BUY", "SELL"]:
-                if not self.coin_finder.has_existing_position(symbol):
-                    if self._open_symbol_position(symbol, target_side):
-                        self.symbol_data[symbol]['last_trade_time'] = time.time()
-                        return True
+                if self._open_symbol_position(symbol, target_side):
+                    self.symbol_data[symbol].last_trade_time = time.time()
+                    return True
             
             return False
             
@@ -544,10 +618,9 @@ class BaseBot:
                 target_side = self._get_side_for_volatility_strategy()
             
             if entry_signal == target_side:
-                if not self.coin_finder.has_existing_position(symbol):
-                    if self._open_symbol_position(symbol, target_side):
-                        self.symbol_data[symbol]['last_trade_time'] = time.time()
-                        return True
+                if self._open_symbol_position(symbol, target_side):
+                    self.symbol_data[symbol].last_trade_time = time.time()
+                    return True
             
             return False
             
@@ -595,27 +668,20 @@ class BaseBot:
     def _check_early_reversal(self, symbol):
         """Kiểm tra điều kiện đảo chiều sớm"""
         try:
-            if not self.symbol_data[symbol]['position_open']:
+            if not self.symbol_data[symbol].position_open:
                 return False
             
             current_price = self.get_current_price(symbol)
             if current_price <= 0:
                 return False
             
-            entry = float(self.symbol_data[symbol]['entry'])
-            side = self.symbol_data[symbol]['side']
+            state = self.symbol_data[symbol]
+            side = state.side
             
-            if side == "BUY":
-                profit = (current_price - entry) * abs(self.symbol_data[symbol]['qty'])
-            else:
-                profit = (entry - current_price) * abs(self.symbol_data[symbol]['qty'])
-            
-            invested = entry * abs(self.symbol_data[symbol]['qty']) / self.lev
-            if invested <= 0:
+            current_roi = state.roi(current_price, self.lev)
+            if current_roi is None:
                 return False
             
-            current_roi = (profit / invested) * 100
-            
             if current_roi <= -50 and self.reverse_on_stop:
                 reversal_signal = self.coin_finder.get_rsi_signal(symbol, volume_threshold=20)
                 
@@ -643,23 +709,17 @@ class BaseBot:
     def _check_smart_exit_condition(self, symbol):
         """Kiểm tra điều kiện thoát thông minh"""
         try:
-            if not self.symbol_data[symbol]['position_open'] or not self.symbol_data[symbol]['roi_check_activated']:
+            state = self.symbol_data[symbol]
+            if not state.position_open or not state.roi_check_activated:
                 return False
             
             current_price = self.get_current_price(symbol)
             if current_price <= 0:
                 return False
             
-            if self.symbol_data[symbol]['side'] == "BUY":
-                profit = (current_price - self.symbol_data[symbol]['entry']) * abs(self.symbol_data[symbol]['qty'])
-            else:
-                profit = (self.symbol_data[symbol]['entry'] - current_price) * abs(self.symbol_data[symbol]['qty'])
-                
-            invested = self.symbol_data[symbol]['entry'] * abs(self.symbol_data[symbol]['qty']) / self.lev
-            if invested <= 0:
+            current_roi = state.roi(current_price, self.lev)
+            if current_roi is None:
                 return False
-                
-            current_roi = (profit / invested) * 100
             
             if current_roi >= self.roi_trigger:
                 exit_signal = self.coin_finder.get_exit_signal(symbol)
@@ -712,72 +772,87 @@ class BaseBot:
         if self.coin_finder.has_existing_position(symbol):
             return False
         
-        self.symbol_data[symbol] = {
-            'status': 'waiting', 'side': '', 'qty': 0, 'entry': 0, 'current_price': 0,
-            'position_open': False, 'last_trade_time': 0, 'last_close_time': 0,
-            'entry_base': 0, 'average_down_count': 0, 'last_average_down_time': 0,
-            'high_water_mark_roi': 0, 'roi_check_activated': False,
-            'close_attempted': False, 'last_close_attempt': 0, 'last_position_check': 0,
-            'pyramiding_count': 0,
-            'next_pyramiding_roi': self.pyramiding_x if self.pyramiding_enabled else 0,
-            'last_pyramiding_time': 0,
-            'pyramiding_base_roi': 0.0,
-        }
-        
-        self.active_symbols.append(symbol)
-        self.coin_manager.register_coin(symbol, self.bot_id)
-        self.ws_manager.add_symbol(symbol, lambda price, sym=symbol: self._handle_price_update(price, sym))
+        # Vừa đóng/mở symbol này: chờ ghi xong để không đọc DB cũ, chưa ghi kịp thì để lượt quét sau
+        if persistence_worker.has_pending(self.bot_id, symbol):
+            persistence_worker.flush(timeout=2.0)
+            if persistence_worker.has_pending(self.bot_id, symbol):
+                return False
+
+        self._track_symbol(symbol)
         
         self._check_symbol_position(symbol)
-        if self.symbol_data[symbol]['position_open']:
+        if self.symbol_data[symbol].position_open:
             self.stop_symbol(symbol)
             return False
         return True
 
+    def _track_symbol(self, symbol):
+        """Đưa symbol vào danh sách theo dõi (RAM, coin manager, WebSocket)"""
+        if symbol not in self.symbol_data:
+            self.symbol_data[symbol] = self._new_symbol_state()
+        if symbol not in self.active_symbols:
+            self.active_symbols.append(symbol)
+        self.coin_manager.register_coin(symbol, self.bot_id)
+        self.ws_manager.add_symbol(symbol, lambda price, sym=symbol: self._handle_price_update(price, sym))
+        if symbol not in self._symbol_timers:
+            self._symbol_timers[symbol] = timer_wheel.schedule(
+                self.position_check_interval, lambda sym=symbol: self._reconcile_symbol(sym),
+                name=f"{self.bot_id}:{symbol}:reconcile")
+
+    def _reconcile_symbol(self, symbol):
+        """Đối soát định kỳ vị thế của symbol với DB/sàn (chạy trên timer wheel)"""
+        # Không chờ khóa: vòng _run đang đặt lệnh/chờ khớp thì bỏ qua lượt này,
+        # tránh chiếm luồng timer wheel dùng chung với bảo vệ ký quỹ và keepalive
+        if not self.execution_lock.acquire(blocking=False):
+            return
+        try:
+            state = self.symbol_data.get(symbol)
+            if state is None or self._stop:
+                return
+            # Còn sự kiện chưa ghi: DB chưa phản ánh RAM, để lần sau
+            if persistence_worker.has_pending(self.bot_id, symbol):
+                return
+            self._check_symbol_position(symbol)
+            state.last_position_check = time.time()
+            self._update_position_in_db(symbol, {})
+        finally:
+            self.execution_lock.release()
+
+    def _new_symbol_state(self):
+        """Tạo trạng thái symbol mới theo cấu hình nhồi lệnh của bot"""
+        return SymbolState(next_pyramiding_roi=self.pyramiding_x if self.pyramiding_enabled else 0)
+
     def _handle_price_update(self, price, symbol):
         """Xử lý cập nhật giá từ WebSocket"""
-        if symbol in self.symbol_data:
-            self.symbol_data[symbol]['current_price'] = price
+        state = self.symbol_data.get(symbol)
+        if state is not None:
+            state.current_price = price
 
     def get_current_price(self, symbol):
         """Lấy giá hiện tại"""
-        if (symbol in self.ws_manager.price_cache and 
-            time.time() - self.ws_manager.last_price_update.get(symbol, 0) < 5):
-            return self.ws_manager.price_cache[symbol]
+        price = self.ws_manager.get_cached_price(symbol, max_age=5)
+        if price is not None:
+            return price
         return get_current_price(symbol)
 
     def _check_symbol_position(self, symbol):
         """Kiểm tra và cập nhật thông tin vị thế"""
         try:
-            db_positions = db_manager.get_open_positions(self.bot_id)
+            state = self.symbol_data[symbol]
+            db_positions = state_repository.get_open_positions(self.bot_id)
             position_found_in_db = False
             
             for pos in db_positions:
                 if pos['symbol'] == symbol:
                     position_found_in_db = True
                     if pos['status'] == 'open':
-                        self.symbol_data[symbol]['position_open'] = True
-                        self.symbol_data[symbol]['status'] = "open"
-                        self.symbol_data[symbol]['side'] = pos['side']
-                        self.symbol_data[symbol]['qty'] = pos['quantity'] * (1 if pos['side'] == 'BUY' else -1)
-                        self.symbol_data[symbol]['entry'] = pos['entry_price']
+                        state.set_open(pos['side'], pos['quantity'], pos['entry_price'])
                         
                         if self.pyramiding_enabled:
-                            self.symbol_data[symbol]['pyramiding_count'] = pos['pyramiding_count']
-                            self.symbol_data[symbol]['next_pyramiding_roi'] = self.pyramiding_x
+                            state.pyramiding_count = pos['pyramiding_count']
+                            state.next_pyramiding_roi = self.pyramiding_x
                         
-                        current_price = self.get_current_price(symbol)
-                        if current_price > 0:
-                            if self.symbol_data[symbol]['side'] == "BUY":
-                                profit = (current_price - self.symbol_data[symbol]['entry']) * abs(self.symbol_data[symbol]['qty'])
-                            else:
-                                profit = (self.symbol_data[symbol]['entry'] - current_price) * abs(self.symbol_data[symbol]['qty'])
-                                
-                            invested = self.symbol_data[symbol]['entry'] * abs(self.symbol_data[symbol]['qty']) / self.lev
-                            if invested > 0:
-                                current_roi = (profit / invested) * 100
-                                if current_roi >= self.roi_trigger:
-                                    self.symbol_data[symbol]['roi_check_activated'] = True
+                        self._activate_roi_check_if_reached(symbol)
                         break
                     else:
                         self._reset_symbol_position(symbol)
@@ -793,30 +868,16 @@ class BaseBot:
                     if pos['symbol'] == symbol:
                         position_amt = float(pos.get('positionAmt', 0))
                         if abs(position_amt) > 0:
-                            self.symbol_data[symbol]['position_open'] = True
-                            self.symbol_data[symbol]['status'] = "open"
-                            self.symbol_data[symbol]['side'] = "BUY" if position_amt > 0 else "SELL"
-                            self.symbol_data[symbol]['qty'] = position_amt
-                            self.symbol_data[symbol]['entry'] = float(pos.get('entryPrice', 0))
+                            state.set_open("BUY" if position_amt > 0 else "SELL", position_amt,
+                                           float(pos.get('entryPrice', 0)))
                             
                             self._save_position_to_db(symbol, "open")
                             
                             if self.pyramiding_enabled:
-                                self.symbol_data[symbol]['pyramiding_count'] = 0
-                                self.symbol_data[symbol]['next_pyramiding_roi'] = self.pyramiding_x
+                                state.pyramiding_count = 0
+                                state.next_pyramiding_roi = self.pyramiding_x
                             
-                            current_price = self.get_current_price(symbol)
-                            if current_price > 0:
-                                if self.symbol_data[symbol]['side'] == "BUY":
-                                    profit = (current_price - self.symbol_data[symbol]['entry']) * abs(self.symbol_data[symbol]['qty'])
-                                else:
-                                    profit = (self.symbol_data[symbol]['entry'] - current_price) * abs(self.symbol_data[symbol]['qty'])
-                                    
-                                invested = self.symbol_data[symbol]['entry'] * abs(self.symbol_data[symbol]['qty']) / self.lev
-                                if invested > 0:
-                                    current_roi = (profit / invested) * 100
-                                    if current_roi >= self.roi_trigger:
-                                        self.symbol_data[symbol]['roi_check_activated'] = True
+                            self._activate_roi_check_if_reached(symbol)
                             break
                         else:
                             self._reset_symbol_position(symbol)
@@ -825,43 +886,74 @@ class BaseBot:
         except Exception as e:
             self.log(f"❌ Lỗi kiểm tra vị thế {symbol}: {str(e)}")
 
+    def _activate_roi_check_if_reached(self, symbol):
+        """Bật kiểm tra ROI nếu vị thế đã đạt ngưỡng kích hoạt"""
+        current_price = self.get_current_price(symbol)
+        if current_price > 0 and self.roi_trigger:
+            current_roi = self.symbol_data[symbol].roi(current_price, self.lev)
+            if current_roi is not None and current_roi >= self.roi_trigger:
+                self.symbol_data[symbol].roi_check_activated = True
+
+    def _publish_position(self, symbol):
+        """Đẩy vị thế hiện tại của symbol sang bộ tổng hợp tài khoản"""
+        state = self.symbol_data.get(symbol)
+        if self.portfolio is None or state is None:
+            return
+        amt = state.qty if state.position_open else 0
+        self.portfolio.apply_position(symbol, amt, entry=state.entry, leverage=self.lev,
+                                      mark=state.current_price or None)
+
     def _reset_symbol_position(self, symbol):
         """Reset thông tin vị thế"""
-        if symbol in self.symbol_data:
-            self.symbol_data[symbol].update({
-                'position_open': False, 'status': "waiting", 'side': "", 'qty': 0, 'entry': 0,
-                'close_attempted': False, 'last_close_attempt': 0, 'entry_base': 0,
-                'average_down_count': 0, 'high_water_mark_roi': 0, 'roi_check_activated': False,
-                'pyramiding_count': 0,
-                'next_pyramiding_roi': self.pyramiding_x if self.pyramiding_enabled else 0,
-                'last_pyramiding_time': 0,
-                'pyramiding_base_roi': 0.0,   
-            })
+        state = self.symbol_data.get(symbol)
+        if state is not None:
+            state.reset_position(self.pyramiding_x if self.pyramiding_enabled else 0)
+
+    def _run_pretrade_checks(self, symbol):
+        """
+        Chạy song song các kiểm tra trước khi vào lệnh, trả về (balance, available, lỗi)
+        - Đòn bẩy chỉ được đặt sau khi xác nhận symbol chưa có vị thế (của bot khác hoặc lệnh tay)
+        """
+        existing_future = api_executor.submit(self.coin_finder.has_existing_position, symbol)
+        balance_future = api_executor.submit(get_total_and_available_balance, self.api_key, self.api_secret)
+
+        if existing_future.result(timeout=20):
+            return None, None, "existing"
+        if not set_leverage(symbol, self.lev, self.api_key, self.api_secret):
+            return None, None, "leverage"
+        balance, available_balance = balance_future.result(timeout=20)
+        return balance, available_balance, None
 
     def _open_symbol_position(self, symbol, side):
         """Mở vị thế mới với database"""
         try:
-            if self.coin_finder.has_existing_position(symbol):
-                self.log(f"⚠️ {symbol} - CÓ VỊ THẾ TRÊN BINANCE, BỎ QUA")
-                self.stop_symbol(symbol)
-                return False
-
-            self._check_symbol_position(symbol)
-            if self.symbol_data[symbol]['position_open']:
+            if self.symbol_data[symbol].position_open:
                 return False
 
+            # Dữ liệu tĩnh lấy từ cache (exchangeInfo), không tốn request
             current_leverage = self.coin_finder.get_symbol_leverage(symbol)
             if current_leverage < self.lev:
                 self.log(f"❌ {symbol} - Đòn bẩy không đủ: {current_leverage}x < {self.lev}x")
                 self.stop_symbol(symbol)
                 return False
 
-            if not set_leverage(symbol, self.lev, self.api_key, self.api_secret):
-                self.log(f"❌ {symbol} - Không thể cài đặt đòn bẩy")
+            current_price = self.get_current_price(symbol)
+            if current_price <= 0:
+                self.log(f"❌ {symbol} - Lỗi giá")
                 self.stop_symbol(symbol)
                 return False
 
-            balance, available_balance = get_total_and_available_balance(self.api_key, self.api_secret)
+            step_size = get_step_size(symbol, self.api_key, self.api_secret)
+
+            balance, available_balance, error = self._run_pretrade_checks(symbol)
+            if error == "existing":
+                self.log(f"⚠️ {symbol} - CÓ VỊ THẾ TRÊN BINANCE, BỎ QUA")
+                self.stop_symbol(symbol)
+                return False
+            if error == "leverage":
+                self.log(f"❌ {symbol} - Không thể cài đặt đòn bẩy")
+                self.stop_symbol(symbol)
+                return False
             
             if balance is None or balance <= 0:
                 self.log(f"❌ {symbol} - Không đủ số dư")
@@ -873,13 +965,6 @@ class BaseBot:
                 self.log(f"❌ {symbol} - Không đủ số dư khả dụng: cần {required_usd:.2f}, khả dụng {available_balance or 0:.2f}")
                 return False
 
-            current_price = self.get_current_price(symbol)
-            if current_price <= 0:
-                self.log(f"❌ {symbol} - Lỗi giá")
-                self.stop_symbol(symbol)
-                return False
-
-            step_size = get_step_size(symbol, self.api_key, self.api_secret)
             usd_amount = balance * (self.percent / 100)
             qty = (usd_amount * self.lev) / current_price
             if step_size > 0:
@@ -891,23 +976,15 @@ class BaseBot:
                 self.stop_symbol(symbol)
                 return False
 
+            # Hủy lệnh chờ cũ xong rồi mới đặt lệnh mới (hủy chạy nền có thể trúng cả lệnh mới)
             cancel_all_orders(symbol, self.api_key, self.api_secret)
-            time.sleep(1)
 
-            result = place_order(symbol, side, qty, self.api_key, self.api_secret)
+            result, fill = place_tracked_order(symbol, side, qty, self.api_key, self.api_secret, prefix="open")
             if result and 'orderId' in result:
-                executed_qty = float(result.get('executedQty', 0))
-                avg_price = float(result.get('avgPrice', current_price))
+                executed_qty = fill['executed_qty'] if fill else 0
+                avg_price = (fill['avg_price'] if fill else 0) or current_price
 
-                if executed_qty >= 0:
-                    time.sleep(1)
-                    self._check_symbol_position(symbol)
-                    
-                    if not self.symbol_data[symbol]['position_open']:
-                        self.log(f"❌ {symbol} - Lệnh đã khớp nhưng không tạo vị thế")
-                        self.stop_symbol(symbol)
-                        return False
-                    
+                if executed_qty > 0:
                     pyramiding_info = {}
                     if self.pyramiding_enabled:
                         pyramiding_info = {
@@ -917,13 +994,12 @@ class BaseBot:
                             'pyramiding_base_roi': 0.0,
                         }
                     
-                    self.symbol_data[symbol].update({
-                        'entry': avg_price, 'entry_base': avg_price, 'average_down_count': 0,
-                        'side': side, 'qty': executed_qty if side == "BUY" else -executed_qty,
-                        'position_open': True, 'status': "open", 'high_water_mark_roi': 0,
-                        'roi_check_activated': False,
-                        **pyramiding_info
-                    })
+                    state = self.symbol_data[symbol]
+                    state.set_open(side, executed_qty, avg_price)
+                    state.update(entry_base=avg_price, average_down_count=0,
+                                 high_water_mark_roi=0.0, roi_check_activated=False,
+                                 **pyramiding_info)
+                    self._publish_position(symbol)
 
                     self.bot_coordinator.bot_has_coin(self.bot_id)
                     
@@ -971,38 +1047,29 @@ class BaseBot:
             if not self.pyramiding_enabled:
                 return False
 
-            info = self.symbol_data.get(symbol)
-            if not info or not info.get('position_open', False):
+            state = self.symbol_data.get(symbol)
+            if state is None or not state.position_open:
                 return False
 
-            current_count = int(info.get('pyramiding_count', 0))
+            current_count = int(state.pyramiding_count)
             if current_count >= self.pyramiding_n:
                 return False
 
             current_time = time.time()
-            if current_time - info.get('last_pyramiding_time', 0) < 60:
+            if current_time - state.last_pyramiding_time < 60:
                 return False
 
             current_price = self.get_current_price(symbol)
             if current_price is None or current_price <= 0:
                 return False
 
-            entry = float(info.get('entry', 0))
-            qty   = abs(float(info.get('qty', 0)))
-            if entry <= 0 or qty <= 0:
+            if state.entry <= 0 or state.abs_qty <= 0:
                 return False
 
-            if info.get('side') == "BUY":
-                profit = (current_price - entry) * qty
-            else:
-                profit = (entry - current_price) * qty
-
-            invested = entry * qty / self.lev
-            if invested <= 0:
+            roi = state.roi(current_price, self.lev)
+            if roi is None:
                 return False
 
-            roi = (profit / invested) * 100
-
             if roi >= 0:
                 return False
 
@@ -1010,7 +1077,7 @@ class BaseBot:
             if step <= 0:
                 return False
 
-            base_roi = float(info.get('pyramiding_base_roi', 0.0))
+            base_roi = float(state.pyramiding_base_roi)
             target_roi = base_roi - step
 
             if roi > target_roi:
@@ -1020,9 +1087,8 @@ class BaseBot:
 
             if self._pyramid_order(symbol):
                 new_count = current_count + 1
-                info['pyramiding_count'] = new_count
-                info['pyramiding_base_roi'] = roi
-                info['last_pyramiding_time'] = current_time
+                state.update(pyramiding_count=new_count, pyramiding_base_roi=roi,
+                             last_pyramiding_time=current_time)
                 
                 self._update_position_in_db(symbol, {'pyramiding_count': new_count})
 
@@ -1038,11 +1104,11 @@ class BaseBot:
     def _pyramid_order(self, symbol):
         """Thực hiện lệnh nhồi với database"""
         try:
-            symbol_info = self.symbol_data[symbol]
-            if not symbol_info['position_open']:
+            state = self.symbol_data[symbol]
+            if not state.position_open:
                 return False
             
-            side = symbol_info['side']
+            side = state.side
             
             balance, available_balance = get_total_and_available_balance(self.api_key, self.api_secret)
             if balance is None or balance <= 0:
@@ -1072,16 +1138,15 @@ class BaseBot:
                 return False
 
             cancel_all_orders(symbol, self.api_key, self.api_secret)
-            time.sleep(1)
 
-            result = place_order(symbol, side, qty, self.api_key, self.api_secret)
+            result, fill = place_tracked_order(symbol, side, qty, self.api_key, self.api_secret, prefix="pyramid")
             if result and 'orderId' in result:
-                executed_qty = float(result.get('executedQty', 0))
-                avg_price = float(result.get('avgPrice', current_price))
+                executed_qty = fill['executed_qty'] if fill else 0
+                avg_price = (fill['avg_price'] if fill else 0) or current_price
 
-                if executed_qty >= 0:
-                    old_qty = symbol_info['qty']
-                    old_entry = symbol_info['entry']
+                if executed_qty > 0:
+                    old_qty = state.qty
+                    old_entry = state.entry
                     
                     total_qty = abs(old_qty) + executed_qty
                     if side == "BUY":
@@ -1091,24 +1156,26 @@ class BaseBot:
                         new_qty = old_qty - executed_qty
                         new_entry = (old_entry * abs(old_qty) + avg_price * executed_qty) / total_qty
                     
-                    symbol_info['qty'] = new_qty
-                    symbol_info['entry'] = new_entry
-                    
-                    self._update_position_in_db(symbol, {})
+                    state.qty = new_qty
+                    state.entry = new_entry
+                    self._publish_position(symbol)
                     
-                    self._save_trade_history(
-                        symbol,
-                        f"PYRAMID_{side}",
-                        avg_price,
-                        executed_qty,
-                        reason=f"Nhồi lệnh lần {symbol_info.get('pyramiding_count', 0) + 1}"
+                    persistence_worker.submit(
+                        self._position_update_event(symbol),
+                        *self._trade_events(
+                            symbol,
+                            f"PYRAMID_{side}",
+                            avg_price,
+                            executed_qty,
+                            reason=f"Nhồi lệnh lần {state.pyramiding_count + 1}"
+                        )
                     )
                     
                     message = (f"🔄 <b>NHỒI LỆNH {symbol}</b>\n"
                               f"🤖 Bot: {self.bot_id}\n📌 Hướng: {side}\n"
                               f"🏷️ Entry: {avg_price:.4f} (Trung bình: {new_entry:.4f})\n"
                               f"📊 Khối lượng: {executed_qty:.4f} (Tổng: {abs(new_qty):.4f})\n"
-                              f"💰 Đòn bẩy: {self.lev}x\n🎯 Lần nhồi: {symbol_info.get('pyramiding_count', 0) + 1}/{self.pyramiding_n}")
+                              f"💰 Đòn bẩy: {self.lev}x\n🎯 Lần nhồi: {state.pyramiding_count + 1}/{self.pyramiding_n}")
                     
                     self.log(message)
                     return True
@@ -1124,142 +1191,160 @@ class BaseBot:
             self.log(f"❌ {symbol} - Lỗi nhồi lệnh: {str(e)}")
             return False
 
-    def _close_symbol_position(self, symbol, reason=""):
-        """Đóng vị thế với database"""
+    def _close_symbol_position(self, symbol, reason="", force=False):
+        """Đóng vị thế với database (force=True bỏ qua giãn cách 30s giữa các lần thử)"""
         try:
-            self._check_symbol_position(symbol)
-            if not self.symbol_data[symbol]['position_open'] or abs(self.symbol_data[symbol]['qty']) <= 0:
+            order = self._prepare_close(symbol, force)
+            if order is None:
                 return True
-
-            current_time = time.time()
-            if (self.symbol_data[symbol]['close_attempted'] and 
-                current_time - self.symbol_data[symbol]['last_close_attempt'] < 30):
+            if order is False:
                 return False
-            
-            self.symbol_data[symbol]['close_attempted'] = True
-            self.symbol_data[symbol]['last_close_attempt'] = current_time
 
-            close_side = "SELL" if self.symbol_data[symbol]['side'] == "BUY" else "BUY"
-            close_qty = abs(self.symbol_data[symbol]['qty'])
-            
-            cancel_all_orders(symbol, self.api_key, self.api_secret)
-            time.sleep(1)
-            
-            result = place_order(symbol, close_side, close_qty, self.api_key, self.api_secret)
-            if result and 'orderId' in result:
-                current_price = self.get_current_price(symbol)
+            result, fill = place_tracked_order(symbol, order['side'], order['quantity'], self.api_key, self.api_secret,
+                                               prefix="close", reduce_only=True)
+            return self._finalize_close(symbol, order, result, fill, reason)
+                
+        except Exception as e:
+            self.log(f"❌ {symbol} - Lỗi đóng vị thế: {str(e)}")
+            if symbol in self.symbol_data:
+                self.symbol_data[symbol].close_attempted = False
+            return False
+
+    def _prepare_close(self, symbol, force=False):
+        """
+        Chuẩn bị lệnh đóng: trả về dict lệnh reduceOnly, None nếu không có vị thế,
+        False nếu vừa thử đóng gần đây
+        """
+        state = self.symbol_data.get(symbol)
+        if state is None or not state.position_open or state.abs_qty <= 0:
+            return None
+
+        current_time = time.time()
+        if not force and state.close_attempted and current_time - state.last_close_attempt < 30:
+            return False
+        
+        state.close_attempted = True
+        state.last_close_attempt = current_time
+
+        cancel_all_orders(symbol, self.api_key, self.api_secret)
+        return {
+            'symbol': symbol,
+            'side': "SELL" if state.side == "BUY" else "BUY",
+            'quantity': state.abs_qty,
+            'reduce_only': True,
+        }
+
+    def _finalize_close(self, symbol, order, result, fill, reason=""):
+        """Ghi nhận kết quả lệnh đóng (đơn lẻ hoặc theo lô) vào RAM, database và Telegram"""
+        try:
+            state = self.symbol_data[symbol]
+            close_side = order['side']
+            close_qty = order['quantity']
+
+            executed_qty = fill['executed_qty'] if fill else 0
+            if result and 'orderId' in result and executed_qty > 0:
+                exit_price = fill['avg_price'] or self.get_current_price(symbol)
                 pnl = 0
                 roi = 0
                 
-                if self.symbol_data[symbol]['entry'] > 0:
-                    if self.symbol_data[symbol]['side'] == "BUY":
-                        pnl = (current_price - self.symbol_data[symbol]['entry']) * abs(self.symbol_data[symbol]['qty'])
-                    else:
-                        pnl = (self.symbol_data[symbol]['entry'] - current_price) * abs(self.symbol_data[symbol]['qty'])
-                    
-                    invested = self.symbol_data[symbol]['entry'] * abs(self.symbol_data[symbol]['qty']) / self.lev
-                    if invested > 0:
-                        roi = (pnl / invested) * 100
-                
-                db_manager.close_position(self.bot_id, symbol, pnl, roi)
+                if state.entry > 0:
+                    pnl = state.pnl(exit_price, executed_qty)
+                    invested = state.entry * executed_qty / self.lev
+                    roi = (pnl / invested) * 100 if invested > 0 else 0
                 
-                self._save_trade_history(
-                    symbol,
-                    f"CLOSE_{close_side}",
-                    current_price,
-                    close_qty,
-                    pnl,
-                    roi,
-                    reason
-                )
+                remaining = close_qty - executed_qty
+                partial = remaining > close_qty * 0.001
+                if partial:
+                    state.qty = remaining if state.side == "BUY" else -remaining
+
+                # Lịch sử, thống kê và trạng thái vị thế: một khối ghi nền, cùng một transaction
+                events = self._trade_events(symbol, f"CLOSE_{close_side}", exit_price, executed_qty, pnl, roi, reason)
+                if partial:
+                    events.append(self._position_update_event(symbol))
+                else:
+                    events.append(PositionClosed(self.bot_id, symbol, pnl, roi))
+                persistence_worker.submit(*events)
+
+                if partial:
+                    state.close_attempted = False
+                    self._publish_position(symbol)
+                    self.log(f"⚠️ {symbol} - Lệnh đóng khớp một phần {executed_qty:.4f}/{close_qty:.4f}, còn lại {remaining:.4f}")
+                    return False
                 
                 pyramiding_info = ""
                 if self.pyramiding_enabled:
-                    pyramiding_count = self.symbol_data[symbol].get('pyramiding_count', 0)
+                    pyramiding_count = state.pyramiding_count
                     pyramiding_info = f"\n🔄 Số lần đã nhồi: {pyramiding_count}/{self.pyramiding_n}"
                 
                 message = (f"⛔ <b>ĐÃ ĐÓNG VỊ THẾ {symbol}</b>\n"
                           f"🤖 Bot: {self.bot_id}\n📌 Lý do: {reason}\n"
-                          f"🏷️ Exit: {current_price:.4f}\n📊 Khối lượng: {close_qty:.4f}\n"
+                          f"🏷️ Exit: {exit_price:.4f}\n📊 Khối lượng: {executed_qty:.4f}\n"
                           f"💰 PnL: {pnl:.2f} USDT | ROI: {roi:.2f}%\n"
-                          f"📈 Lần hạ giá trung bình: {self.symbol_data[symbol]['average_down_count']}"
+                          f"📈 Lần hạ giá trung bình: {state.average_down_count}"
                           f"{pyramiding_info}")
                 self.log(message)
                 
-                self.symbol_data[symbol]['last_close_time'] = time.time()
+                state.last_close_time = time.time()
                 self._reset_symbol_position(symbol)
+                self._publish_position(symbol)
                 self.bot_coordinator.bot_lost_coin(self.bot_id)
                 return True
             else:
-                error_msg = result.get('msg', 'Lỗi không xác định') if result else 'Không có phản hồi'
+                if result and 'orderId' in result:
+                    error_msg = f"Lệnh chưa khớp ({fill['status'] if fill else 'không rõ trạng thái'})"
+                else:
+                    error_msg = result.get('msg', 'Lỗi không xác định') if result else 'Không có phản hồi'
                 self.log(f"❌ {symbol} - Lỗi lệnh đóng: {error_msg}")
-                self.symbol_data[symbol]['close_attempted'] = False
+                state.close_attempted = False
+
+                # Lệnh reduceOnly bị từ chối thường do vị thế đã không còn trên sàn
+                positions = [] if result and 'orderId' in result else get_positions(symbol, self.api_key, self.api_secret)
+                if positions and not any(abs(float(p.get('positionAmt', 0) or 0)) > 0 for p in positions):
+                    self.log(f"⚠️ {symbol} - Vị thế không còn trên Binance, đồng bộ lại trạng thái")
+                    persistence_worker.submit(PositionClosed(self.bot_id, symbol))
+                    state.last_close_time = time.time()
+                    self._reset_symbol_position(symbol)
+                    self._publish_position(symbol)
+                    self.bot_coordinator.bot_lost_coin(self.bot_id)
+                    return True
                 return False
                 
         except Exception as e:
-            self.log(f"❌ {symbol} - Lỗi đóng vị thế: {str(e)}")
-            self.symbol_data[symbol]['close_attempted'] = False
+            self.log(f"❌ {symbol} - Lỗi ghi nhận đóng vị thế: {str(e)}")
+            if symbol in self.symbol_data:
+                self.symbol_data[symbol].close_attempted = False
             return False
 
-    def _check_margin_safety(self):
-        """Kiểm tra an toàn ký quỹ toàn tài khoản"""
+    def _on_margin_breach(self, ratio):
+        """Hành động bảo vệ do MarginGuardian của tài khoản gọi (một lần cho mỗi sự cố)"""
         try:
-            margin_balance, maint_margin, ratio = get_margin_safety_info(
-                self.api_key, self.api_secret
-            )
-
-            if margin_balance is None or maint_margin is None or ratio is None:
-                return False
-
-            if ratio <= self.margin_safety_threshold:
-                msg = (f"🛑 BẢO VỆ KÝ QUỸ ĐƯỢC KÍCH HOẠT\n"
-                      f"• Margin / Maint = {ratio:.2f}x ≤ {self.margin_safety_threshold:.2f}x\n"
-                      f"• Đang đóng toàn bộ vị thế của bot để tránh thanh lý.")
-                self.log(msg)
-
-                send_telegram(
-                    msg,
-                    chat_id=self.telegram_chat_id,
-                    bot_token=self.telegram_bot_token,
-                    default_chat_id=self.telegram_chat_id,
-                )
-
-                self.stop_all_symbols()
-                return True
-
-            return False
-
+            msg = (f"🛑 BẢO VỆ KÝ QUỸ ĐƯỢC KÍCH HOẠT\n"
+                  f"• Margin / Maint = {ratio:.2f}x ≤ {self.margin_safety_threshold:.2f}x\n"
+                  f"• Đang đóng toàn bộ vị thế của bot để tránh thanh lý.")
+            self.log(msg)
+            self.stop_all_symbols()
         except Exception as e:
-            self.log(f"❌ Lỗi kiểm tra an toàn ký quỹ: {str(e)}")
-            return False
+            self.log(f"❌ Lỗi bảo vệ ký quỹ: {str(e)}")
 
     def _check_symbol_tp_sl(self, symbol):
         """Kiểm tra Take Profit và Stop Loss"""
-        if (not self.symbol_data[symbol]['position_open'] or 
-            self.symbol_data[symbol]['entry'] <= 0 or 
-            self.symbol_data[symbol]['close_attempted']):
+        state = self.symbol_data[symbol]
+        if not state.position_open or state.entry <= 0 or state.close_attempted:
             return
 
         current_price = self.get_current_price(symbol)
         if current_price <= 0: return
 
-        if self.symbol_data[symbol]['side'] == "BUY":
-            profit = (current_price - self.symbol_data[symbol]['entry']) * abs(self.symbol_data[symbol]['qty'])
-        else:
-            profit = (self.symbol_data[symbol]['entry'] - current_price) * abs(self.symbol_data[symbol]['qty'])
-            
-        invested = self.symbol_data[symbol]['entry'] * abs(self.symbol_data[symbol]['qty']) / self.lev
-        if invested <= 0: return
-            
-        roi = (profit / invested) * 100
+        roi = state.roi(current_price, self.lev)
+        if roi is None: return
 
-        if roi > self.symbol_data[symbol]['high_water_mark_roi']:
-            self.symbol_data[symbol]['high_water_mark_roi'] = roi
+        if roi > state.high_water_mark_roi:
+            state.high_water_mark_roi = roi
 
         if (self.roi_trigger is not None and 
-            self.symbol_data[symbol]['high_water_mark_roi'] >= self.roi_trigger and 
-            not self.symbol_data[symbol]['roi_check_activated']):
-            self.symbol_data[symbol]['roi_check_activated'] = True
+            state.high_water_mark_roi >= self.roi_trigger and 
+            not state.roi_check_activated):
+            state.roi_check_activated = True
 
         if self.tp is not None and roi >= self.tp:
             self._close_symbol_position(symbol, f"✅ Đạt TP {self.tp}% (ROI: {roi:.2f}%)")
@@ -1268,92 +1353,20 @@ class BaseBot:
 
     def check_global_positions(self):
         """
-        Cập nhật tổng khối lượng LONG/SHORT toàn tài khoản
+        Cập nhật tổng khối lượng LONG/SHORT toàn tài khoản (đọc từ bộ tổng hợp dùng chung)
         """
         try:
-            positions = get_positions(api_key=self.api_key, api_secret=self.api_secret)
-
-            if not positions:
-                self.global_long_count = 0
-                self.global_short_count = 0
-                self.global_long_pnl = 0
-                self.global_short_pnl = 0
-                self.global_long_volume = 0.0
-                self.global_short_volume = 0.0
-
-                self.next_global_side = random.choice(["BUY", "SELL"])
+            if self.portfolio is None:
                 return
 
-            long_count, short_count = 0, 0
-            long_volume, short_volume = 0.0, 0.0
-
-            for pos in positions:
-                position_amt = float(pos.get("positionAmt", 0.0))
-                if position_amt == 0:
-                    continue
-
-                if position_amt > 0:
-                    long_count += 1
-                elif position_amt < 0:
-                    short_count += 1
-
-                try:
-                    lev = float(pos.get("leverage", 1.0))
-                except Exception:
-                    lev = 1.0
-
-                price = 0.0
-                try:
-                    price = float(pos.get("markPrice") or 0.0)
-                except Exception:
-                    price = 0.0
-
-                if price <= 0:
-                    try:
-                        price = float(pos.get("entryPrice") or 0.0)
-                    except Exception:
-                        price = 0.0
-
-                if price <= 0:
-                    continue
-
-                notional = abs(position_amt) * price
-                effective_volume = notional * lev
-
-                if position_amt > 0:
-                    long_volume += effective_volume
-                elif position_amt < 0:
-                    short_volume += effective_volume
-
-            self.global_long_count = long_count
-            self.global_short_count = short_count
+            snapshot = self.portfolio.snapshot()
+            self.global_long_count = snapshot['long_count']
+            self.global_short_count = snapshot['short_count']
             self.global_long_pnl = 0
             self.global_short_pnl = 0
-            self.global_long_volume = long_volume
-            self.global_short_volume = short_volume
-
-            if long_volume > 0 or short_volume > 0:
-                diff = abs(long_volume - short_volume)
-                total = long_volume + short_volume
-                if total > 0:
-                    imbalance = diff / total
-                else:
-                    imbalance = 0
-
-                if imbalance < 0.01:
-                    self.next_global_side = random.choice(["BUY", "SELL"])
-                else:
-                    if long_volume > short_volume:
-                        self.next_global_side = "SELL"
-                    else:
-                        self.next_global_side = "BUY"
-            else:
-                if long_count > short_count:
-                    self.next_global_side = "SELL"
-                elif short_count > long_count:
-                    self.next_global_side = "BUY"
-                else:
-                    self.next_global_side = random.choice(["BUY", "SELL"])
+            self.global_long_volume = snapshot['long_volume']
+            self.global_short_volume = snapshot['short_volume']
+            self.next_global_side = snapshot['next_global_side'] or random.choice(["BUY", "SELL"])
 
         except Exception as e:
             if time.time() - self.last_error_log_time > 30:
@@ -1373,18 +1386,16 @@ class BaseBot:
             while self.current_processing_symbol == symbol and time.time() < timeout:
                 time.sleep(1)
         
-        if self.symbol_data[symbol]['position_open']:
+        if self.symbol_data[symbol].position_open:
             self._close_symbol_position(symbol, "Dừng coin theo lệnh")
         
         self.ws_manager.remove_symbol(symbol)
         self.coin_manager.unregister_coin(symbol, self.bot_id)
         
-        try:
-            query = "DELETE FROM bot_positions WHERE bot_id = %s AND symbol = %s"
-            db_manager.execute_query(query, (self.bot_id, symbol))
-        except Exception as e:
-            logger.error(f"Lỗi xóa vị thế {symbol} từ database: {str(e)}")
+        persistence_worker.submit(PositionDeleted(self.bot_id, symbol))
         
+        timer = self._symbol_timers.pop(symbol, None)
+        if timer: timer.cancel()
         if symbol in self.symbol_data: del self.symbol_data[symbol]
         if symbol in self.active_symbols: self.active_symbols.remove(symbol)
         
@@ -1398,10 +1409,12 @@ class BaseBot:
         symbols_to_stop = self.active_symbols.copy()
         stopped_count = 0
         
+        # Đóng các vị thế đang mở trong một lô lệnh, sau đó dừng theo dõi từng coin
+        close_positions_in_batch([(self, symbol) for symbol in symbols_to_stop], "Dừng coin theo lệnh")
+        
         for symbol in symbols_to_stop:
             if self.stop_symbol(symbol):
                 stopped_count += 1
-                time.sleep(1)
         
         self.log(f"✅ Đã dừng {stopped_count} coin, bot vẫn chạy")
         return stopped_count
@@ -1409,6 +1422,9 @@ class BaseBot:
     def stop(self):
         """Dừng bot hoàn toàn và cập nhật database"""
         self._stop = True
+        self._global_timer.cancel()
+        if self.margin_guardian is not None:
+            self.margin_guardian.remove_protective_action(self._on_margin_breach)
         
         db_manager.update_bot_status(self.bot_id, "stopped")
         
@@ -1417,14 +1433,43 @@ class BaseBot:
 
     def log(self, message):
         """Ghi log và gửi thông báo Telegram"""
-        important_keywords = ['❌', '✅', '⛔', '💰', '📈', '📊', '🎯', '🛡️', '🔴', '🟢', '⚠️', '🚫', '🔄']
+        important_keywords = ['❌', '✅', '⛔', '💰', '📈', '📊', '🎯', '🛡️', '🔴', '🟢', '⚠️', '🚫', '🔄', '🚨']
         if any(keyword in message for keyword in important_keywords):
             logger.warning(f"[{self.bot_id}] {message}")
             if self.telegram_bot_token and self.telegram_chat_id:
-                send_telegram(f"<b>{self.bot_id}</b>: {message}", 
+                send_telegram_async(f"<b>{self.bot_id}</b>: {message}", 
                              bot_token=self.telegram_bot_token, 
                              default_chat_id=self.telegram_chat_id)
 
+# ========== ĐÓNG VỊ THẾ THEO LÔ ==========
+def close_positions_in_batch(bot_symbols, reason="", force=False, timeout=5):
+    """
+    Đóng nhiều vị thế (có thể thuộc nhiều bot) bằng /fapi/v1/batchOrders, gom theo tài khoản.
+    bot_symbols: list (bot, symbol). timeout: thời gian chờ khớp tối đa cho mỗi lô.
+    Trả về dict {(bot_id, symbol): đã đóng hay chưa}
+    """
+    by_account = defaultdict(list)
+    outcome = {}
+    for bot, symbol in bot_symbols:
+        try:
+            order = bot._prepare_close(symbol, force)
+        except Exception as e:
+            logger.error(f"❌ Lỗi chuẩn bị đóng {symbol}: {str(e)}")
+            order = False
+        if order is None:
+            outcome[(bot.bot_id, symbol)] = True
+        elif order is False:
+            outcome[(bot.bot_id, symbol)] = False
+        else:
+            by_account[(bot.api_key, bot.api_secret)].append((bot, symbol, order))
+
+    for (api_key, api_secret), items in by_account.items():
+        orders = [dict(order) for _, _, order in items]
+        results = place_tracked_batch(orders, api_key, api_secret, prefix="close", timeout=timeout)
+        for (bot, symbol, order), (result, fill) in zip(items, results):
+            outcome[(bot.bot_id, symbol)] = bot._finalize_close(symbol, order, result, fill, reason)
+    return outcome
+
 # ========== CÁC LỚP BOT CỤ THỂ ==========
 
 class BalanceProtectionBot(BaseBot):
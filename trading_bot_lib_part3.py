@@ -3,12 +3,13 @@
 from trading_bot_lib_part1 import (
     logger, get_all_usdt_pairs, get_max_leverage, get_step_size,
     set_leverage, get_total_and_available_balance, get_margin_safety_info,
-    place_order, cancel_all_orders, get_current_price, get_positions,
+    place_order, place_tracked_order, place_tracked_batch, cancel_all_orders, get_current_price, get_positions,
     CoinManager, BotExecutionCoordinator, SmartCoinFinder, WebSocketManager,
-    send_telegram, get_balance, db_manager
+    send_telegram, send_telegram_async, get_balance, get_margin_guardian, get_portfolio_aggregator, db_manager,
+    state_repository
 )
 
-from trading_bot_lib_part2 import BalanceProtectionBot, CompoundProfitBot, StaticMarketBot
+from trading_bot_lib_part2 import BalanceProtectionBot, CompoundProfitBot, StaticMarketBot, close_positions_in_batch
 
 import time
 import threading
@@ -16,6 +17,7 @@ import requests
 import json
 import os
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # ========== HÀM TẠO BÀN PHÍM TELEGRAM ==========
 def create_main_menu():
@@ -156,9 +158,12 @@ def create_pyramiding_x_keyboard():
 # ========== LỚP QUẢN LÝ BOT ==========
 class BotManager:
     """Quản lý toàn bộ hệ thống bot với database và telegram"""
+
+    # Tiến trình worker khi chia shard không nghe Telegram (supervisor đảm nhận)
+    handles_telegram = True
     
     def __init__(self, api_key=None, api_secret=None, telegram_bot_token=None, telegram_chat_id=None):
-        self.ws_manager = WebSocketManager()
+        self.ws_manager = self._create_ws_manager()
         self.bots = {}
         self.running = True
         self.start_time = time.time()
@@ -176,6 +181,9 @@ class BotManager:
         self._restore_bots_from_db()
 
         if api_key and api_secret:
+            self._attach_margin_guardian(api_key, api_secret)
+
+        if api_key and api_secret and self.handles_telegram:
             self._verify_api_connection()
             self.log("🟢 HỆ THỐNG BOT HÀNG ĐỢI ĐÃ KHỞI ĐỘNG")
 
@@ -184,68 +192,167 @@ class BotManager:
 
             if self.telegram_chat_id:
                 self.send_main_menu(self.telegram_chat_id)
-        else:
+        elif not (api_key and api_secret):
             self.log("⚡ BotManager đã khởi động ở chế độ không cấu hình")
 
+    def _create_ws_manager(self):
+        """Nguồn giá thời gian thực cho các bot (worker shard dùng bảng giá chia sẻ)"""
+        return WebSocketManager()
+
+    def _attach_margin_guardian(self, api_key, api_secret):
+        """Sự cố ký quỹ trên tài khoản chính: đóng khẩn cấp toàn bộ thay vì từng bot tự xử lý"""
+        guardian = get_margin_guardian(api_key, api_secret)
+        if guardian is not None:
+            guardian.set_account_action(lambda ratio: self.emergency_flatten(api_key, reason=f"🛑 Bảo vệ ký quỹ ({ratio:.2f}x)"))
+
+    def _owns_bot_config(self, bot_config):
+        """Bot cấu hình này có do tiến trình hiện tại quản lý không (worker shard lọc lại)"""
+        return True
+
+    def _new_bot_id(self, bot_mode, symbol, dynamic_strategy, index):
+        """Sinh bot_id mới theo loại bot"""
+        if bot_mode == 'static' and symbol:
+            return f"STATIC_{symbol}_{int(time.time())}_{index}"
+        return f"DYNAMIC_{dynamic_strategy}_{int(time.time())}_{index}"
+
     # ========== DATABASE METHODS ==========
     
+    def _fetch_positions_snapshots(self, bots_config):
+        """Lấy positionRisk một lần cho mỗi tài khoản (song song) để các bot dùng chung khi khôi phục"""
+        accounts = {}
+        for bot_config in bots_config:
+            api_key = bot_config.get('api_key') or self.api_key
+            api_secret = bot_config.get('api_secret') or self.api_secret
+            if api_key and api_secret:
+                accounts[(api_key, api_secret)] = True
+
+        snapshots = {}
+        if not accounts:
+            return snapshots
+
+        with ThreadPoolExecutor(max_workers=min(8, len(accounts)), thread_name_prefix="restore-pos") as executor:
+            futures = {executor.submit(get_positions, None, key, secret): (key, secret) for key, secret in accounts}
+            for future, account in futures.items():
+                try:
+                    positions = future.result()
+                except Exception as e:
+                    logger.error(f"❌ Lỗi lấy vị thế khi khôi phục: {str(e)}")
+                    positions = None
+                # positionRisk luôn trả đủ symbol, rỗng nghĩa là lỗi => để bot tự lấy lại
+                if not positions:
+                    continue
+                snapshots[account] = positions
+                get_portfolio_aggregator(*account).refresh(positions)
+        return snapshots
+
     def _restore_bots_from_db(self):
         """Khôi phục bot từ database khi khởi động"""
         try:
-            bots_config = db_manager.get_all_bots(status='running')
-            
-            for bot_config in bots_config:
-                try:
-                    bot_id = bot_config['bot_id']
-                    
-                    if bot_id in self.bots:
-                        continue
-                    
-                    bot_mode = bot_config['bot_mode']
-                    
-                    if bot_mode == 'static':
-                        bot_class = StaticMarketBot
-                        symbol = bot_config['symbol']
+            all_configs = db_manager.get_all_bots(status='running')
+            bots_config = [c for c in all_configs if c['bot_id'] not in self.bots and self._owns_bot_config(c)]
+            snapshots = self._fetch_positions_snapshots(bots_config)
+
+            def build_bot(bot_config):
+                bot_id = bot_config['bot_id']
+                api_key = bot_config['api_key'] or self.api_key
+                api_secret = bot_config['api_secret'] or self.api_secret
+                
+                bot_mode = bot_config['bot_mode']
+                
+                if bot_mode == 'static':
+                    bot_class = StaticMarketBot
+                    symbol = bot_config['symbol']
+                else:
+                    if bot_config['dynamic_strategy'] == 'volume':
+                        bot_class = CompoundProfitBot
                     else:
-                        if bot_config['dynamic_strategy'] == 'volume':
-                            bot_class = CompoundProfitBot
-                        else:
-                            bot_class = BalanceProtectionBot
-                        symbol = None
-                    
-                    bot = bot_class(
-                        symbol=symbol,
-                        lev=bot_config['leverage'],
-                        percent=bot_config['percent'],
-                        tp=bot_config['tp'],
-                        sl=bot_config['sl'],
-                        roi_trigger=bot_config['roi_trigger'],
-                        ws_manager=self.ws_manager,
-                        api_key=bot_config['api_key'] or self.api_key,
-                        api_secret=bot_config['api_secret'] or self.api_secret,
-                        telegram_bot_token=bot_config.get('telegram_chat_id') or self.telegram_bot_token,
-                        telegram_chat_id=bot_config.get('telegram_chat_id') or self.telegram_chat_id,
-                        bot_id=bot_id,
-                        coin_manager=self.coin_manager,
-                        symbol_locks=self.symbol_locks,
-                        bot_coordinator=self.bot_coordinator,
-                        pyramiding_n=bot_config['pyramiding_n'],
-                        pyramiding_x=bot_config['pyramiding_x'],
-                        dynamic_strategy=bot_config['dynamic_strategy'],
-                        static_entry_mode=bot_config['static_entry_mode'],
-                        reverse_on_stop=bot_config['reverse_on_stop']
-                    )
-                    
-                    self.bots[bot_id] = bot
-                    self.log(f"✅ Đã khôi phục bot {bot_id} từ database")
-                    
-                except Exception as e:
-                    self.log(f"❌ Lỗi khôi phục bot {bot_config.get('bot_id', 'unknown')}: {str(e)}")
+                        bot_class = BalanceProtectionBot
+                    symbol = None
+                
+                bot = bot_class(
+                    symbol=symbol,
+                    lev=bot_config['leverage'],
+                    percent=bot_config['percent'],
+                    tp=bot_config['tp'],
+                    sl=bot_config['sl'],
+                    roi_trigger=bot_config['roi_trigger'],
+                    ws_manager=self.ws_manager,
+                    api_key=api_key,
+                    api_secret=api_secret,
+                    telegram_bot_token=bot_config.get('telegram_chat_id') or self.telegram_bot_token,
+                    telegram_chat_id=bot_config.get('telegram_chat_id') or self.telegram_chat_id,
+                    bot_id=bot_id,
+                    coin_manager=self.coin_manager,
+                    symbol_locks=self.symbol_locks,
+                    bot_coordinator=self.bot_coordinator,
+                    pyramiding_n=bot_config['pyramiding_n'],
+                    pyramiding_x=bot_config['pyramiding_x'],
+                    dynamic_strategy=bot_config['dynamic_strategy'],
+                    static_entry_mode=bot_config['static_entry_mode'],
+                    reverse_on_stop=bot_config['reverse_on_stop'],
+                    positions_snapshot=snapshots.get((api_key, api_secret)),
+                    persist_config=False
+                )
+                return bot
+
+            restored = 0
+            if bots_config:
+                # Khởi tạo song song; chỉ luồng chính ghi vào self.bots
+                with ThreadPoolExecutor(max_workers=min(8, len(bots_config)), thread_name_prefix="restore-bot") as executor:
+                    futures = [(bot_config, executor.submit(build_bot, bot_config)) for bot_config in bots_config]
+                    for bot_config, future in futures:
+                        try:
+                            bot = future.result()
+                            self.bots[bot_config['bot_id']] = bot
+                            restored += 1
+                            self.log(f"✅ Đã khôi phục bot {bot_config['bot_id']} từ database")
+                        except Exception as e:
+                            self.log(f"❌ Lỗi khôi phục bot {bot_config.get('bot_id', 'unknown')}: {str(e)}")
             
-            self.log(f"✅ Đã khôi phục {len(bots_config)} bot từ database")
+            self.log(f"✅ Đã khôi phục {restored}/{len(bots_config)} bot từ database")
+            self._adopt_orphan_positions(all_configs, snapshots)
             
         except Exception as e:
             self.log(f"❌ Lỗi khôi phục bot từ database: {str(e)}")
+
+    def _adopt_orphan_positions(self, bots_config, snapshots):
+        """
+        Vị thế trên sàn không có dòng 'open' của bot nào (ghi nền bị mất, tiến trình chết khi còn trong hàng đợi):
+        - Giao cho bot động có bot_id nhỏ nhất của tài khoản (cùng kết quả ở mọi shard, chỉ shard sở hữu bot đó xử lý)
+        - Không có bot động nào nhận được thì cảnh báo 🚨 để xử lý tay
+        """
+        account_of = {c['bot_id']: c.get('api_key') or self.api_key for c in bots_config}
+        open_rows = state_repository.get_open_positions()
+
+        for (api_key, api_secret), positions in snapshots.items():
+            account_configs = sorted((c for c in bots_config if (c.get('api_key') or self.api_key) == api_key),
+                                     key=lambda c: c['bot_id'])
+            if not account_configs:
+                continue
+            dynamic = [c for c in account_configs if c['bot_mode'] != 'static']
+            responsible = (dynamic or account_configs)[0]
+            if not self._owns_bot_config(responsible):
+                continue
+
+            # Bot không còn trong cấu hình: không rõ tài khoản, coi dòng của nó là đã có chủ
+            owned = {(row.get('symbol') or '').upper() for row in open_rows
+                     if account_of.get(row.get('bot_id'), api_key) == api_key}
+            owned |= {(c.get('symbol') or '').upper() for c in account_configs if c['bot_mode'] == 'static'}
+            orphans = sorted({
+                (p.get('symbol') or '').upper() for p in positions
+                if float(p.get('positionAmt', 0) or 0) != 0 and (p.get('symbol') or '').upper() not in owned
+            })
+            if not orphans:
+                continue
+
+            owner = self.bots.get(responsible['bot_id']) if dynamic else None
+            if owner is None:
+                self.log(f"🚨 Có {len(orphans)} vị thế trên sàn không bot nào quản lý: {', '.join(orphans)}")
+                continue
+            try:
+                owner.adopt_positions(orphans, positions)
+            except Exception as e:
+                self.log(f"🚨 Lỗi giao vị thế không có chủ ({', '.join(orphans)}) cho {owner.bot_id}: {str(e)}")
     
     def _verify_api_connection(self):
         """Xác minh kết nối API Binance"""
@@ -267,8 +374,8 @@ class BotManager:
     def get_position_summary(self):
         """Lấy tổng hợp thống kê chi tiết từ database"""
         try:
-            all_bots = db_manager.get_all_bots()
-            open_positions = db_manager.get_open_positions()
+            all_bots = state_repository.get_all_bots()
+            open_positions = state_repository.get_open_positions()
             statistics = db_manager.get_statistics()
             
             summary = "📊 **THỐNG KÊ CHI TIẾT**\n\n"
@@ -345,11 +452,11 @@ class BotManager:
 
     def log(self, message):
         """Ghi log hệ thống"""
-        important_keywords = ['❌', '✅', '⛔', '💰', '📈', '📊', '🎯', '🛡️', '🔴', '🟢', '⚠️', '🚫', '🔄']
+        important_keywords = ['❌', '✅', '⛔', '💰', '📈', '📊', '🎯', '🛡️', '🔴', '🟢', '⚠️', '🚫', '🔄', '🚨']
         if any(keyword in message for keyword in important_keywords):
             logger.warning(f"[HỆ THỐNG] {message}")
             if self.telegram_bot_token and self.telegram_chat_id:
-                send_telegram(f"<b>HỆ THỐNG</b>: {message}", 
+                send_telegram_async(f"<b>HỆ THỐNG</b>: {message}", 
                              chat_id=self.telegram_chat_id,
                              bot_token=self.telegram_bot_token, 
                              default_chat_id=self.telegram_chat_id)
@@ -461,15 +568,16 @@ class BotManager:
         pyramiding_n = kwargs.get('pyramiding_n', 0)
         pyramiding_x = kwargs.get('pyramiding_x', 0)
         reverse_on_stop = kwargs.get('reverse_on_stop', False)
+        # bot_ids: id đã được supervisor sinh sẵn khi chia shard
+        bot_ids = kwargs.get('bot_ids')
+        if bot_ids:
+            bot_count = len(bot_ids)
         
         created_count = 0
         
         try:
             for i in range(bot_count):
-                if bot_mode == 'static' and symbol:
-                    bot_id = f"STATIC_{symbol}_{int(time.time())}_{i}"
-                else:
-                    bot_id = f"DYNAMIC_{dynamic_strategy}_{int(time.time())}_{i}"
+                bot_id = bot_ids[i] if bot_ids else self._new_bot_id(bot_mode, symbol, dynamic_strategy, i)
                 
                 if bot_id in self.bots: continue
                 
@@ -631,6 +739,12 @@ class BotManager:
         """Dừng tất cả coin trong tất cả bot"""
         self.log("⛔ Đang dừng tất cả coin trong tất cả bot...")
         total_stopped = 0
+        
+        # Đóng toàn bộ vị thế của mọi bot theo lô (gom theo tài khoản) trước khi dừng từng bot
+        bot_symbols = [(bot, symbol) for bot in self.bots.values()
+                       if hasattr(bot, 'active_symbols') for symbol in list(bot.active_symbols)]
+        close_positions_in_batch(bot_symbols, "Dừng coin theo lệnh")
+        
         for bot_id, bot in self.bots.items():
             if hasattr(bot, 'stop_all_symbols'):
                 stopped_count = bot.stop_all_symbols()
@@ -681,6 +795,119 @@ class BotManager:
             self.stop_bot(bot_id)
         self.log("🔴 Đã dừng tất cả bot, hệ thống vẫn chạy")
 
+    # ========== ĐÓNG KHẨN CẤP ==========
+    def emergency_flatten(self, api_key=None, deadline=10.0, max_workers=8, reason="🚨 Đóng khẩn cấp",
+                          include_unmanaged=True):
+        """
+        Đóng toàn bộ vị thế của một tài khoản song song, có hạn chót:
+        - Vị thế do bot quản lý: đóng qua bot (ghi PnL, DB như bình thường)
+        - Vị thế ngoài bot trên positionRisk: đóng trực tiếp bằng lệnh reduceOnly (nếu include_unmanaged)
+        - Lỗi thì thử lại cho tới hạn chót, cuối cùng trả về báo cáo
+        """
+        api_key = api_key or self.api_key
+        bots = [bot for bot in self.bots.values() if bot.api_key == api_key]
+        api_secret = bots[0].api_secret if bots else self.api_secret
+        if not api_key or not api_secret:
+            return None
+
+        start_time = time.time()
+        end_time = start_time + deadline
+        self.log(f"🚨 ĐÓNG KHẨN CẤP TÀI KHOẢN: {reason}")
+
+        tasks = {}
+        for bot in bots:
+            for symbol in list(bot.active_symbols):
+                state = bot.symbol_data.get(symbol)
+                if state is not None and state.position_open:
+                    tasks[symbol] = ('bot', bot)
+
+        unmanaged = get_positions(api_key=api_key, api_secret=api_secret) if include_unmanaged else []
+        for pos in unmanaged or []:
+            symbol = pos.get('symbol')
+            amt = float(pos.get('positionAmt', 0) or 0)
+            if symbol and amt != 0 and symbol not in tasks:
+                tasks[symbol] = ('raw', amt)
+
+        def close_task(symbol, task):
+            kind, target = task
+            if kind == 'bot':
+                return target._close_symbol_position(symbol, reason, force=True)
+            side = "SELL" if target > 0 else "BUY"
+            result, fill = place_tracked_order(symbol, side, abs(target), api_key, api_secret,
+                                               prefix="flat", reduce_only=True)
+            return bool(fill and fill['executed_qty'] >= abs(target) * 0.999)
+
+        closed, attempts = [], defaultdict(int)
+        pending = dict(tasks)
+
+        # Lượt đầu: gửi tất cả theo lô để tốn ít request nhất, chờ khớp không quá hạn chót
+        try:
+            bot_items = [(task[1], sym) for sym, task in tasks.items() if task[0] == 'bot']
+            outcome = close_positions_in_batch(bot_items, reason, force=True,
+                                               timeout=max(0.1, end_time - time.time()))
+            for bot, symbol in bot_items:
+                attempts[symbol] += 1
+                if outcome.get((bot.bot_id, symbol)):
+                    closed.append(symbol)
+                    pending.pop(symbol, None)
+
+            raw_items = [(sym, task[1]) for sym, task in tasks.items() if task[0] == 'raw']
+            raw_orders = [{'symbol': sym, 'side': "SELL" if amt > 0 else "BUY", 'quantity': abs(amt), 'reduce_only': True}
+                          for sym, amt in raw_items]
+            raw_results = place_tracked_batch(raw_orders, api_key, api_secret, prefix="flat",
+                                              timeout=max(0.1, end_time - time.time()))
+            for (symbol, amt), (result, fill) in zip(raw_items, raw_results):
+                attempts[symbol] += 1
+                if fill and fill['executed_qty'] >= abs(amt) * 0.999:
+                    closed.append(symbol)
+                    pending.pop(symbol, None)
+        except Exception as e:
+            logger.error(f"❌ Lỗi đóng khẩn cấp theo lô: {str(e)}")
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="flatten")
+        try:
+            while pending and time.time() < end_time:
+                futures = {executor.submit(close_task, sym, task): sym for sym, task in pending.items()}
+                done, not_done = wait(futures, timeout=max(0.0, end_time - time.time()))
+                for future in done:
+                    symbol = futures[future]
+                    attempts[symbol] += 1
+                    try:
+                        ok = future.result()
+                    except Exception as e:
+                        logger.error(f"❌ Lỗi đóng khẩn cấp {symbol}: {str(e)}")
+                        ok = False
+                    if ok:
+                        closed.append(symbol)
+                        pending.pop(symbol, None)
+                if not_done:
+                    break
+                if pending:
+                    time.sleep(0.2)
+        finally:
+            # Không chờ các lệnh còn treo quá hạn chót
+            executor.shutdown(wait=False)
+
+        # Sau khi đóng: bot dừng theo dõi các coin đã đóng (không còn lệnh REST)
+        for symbol in closed:
+            kind, target = tasks[symbol]
+            if kind == 'bot' and symbol in target.active_symbols:
+                try:
+                    target.stop_symbol(symbol)
+                except Exception as e:
+                    logger.error(f"Lỗi dừng coin {symbol} sau đóng khẩn cấp: {str(e)}")
+
+        report = {
+            'closed': closed,
+            'failed': list(pending.keys()),
+            'attempts': dict(attempts),
+            'elapsed': round(time.time() - start_time, 2),
+        }
+        status = "✅" if not pending else "⚠️"
+        self.log(f"{status} ĐÓNG KHẨN CẤP XONG sau {report['elapsed']}s | "
+                 f"Đã đóng: {len(closed)}/{len(tasks)}"
+                 + (f" | Chưa đóng: {', '.join(report['failed'])}" if pending else ""))
+        return report
+
     # ========== LISTENER TELEGRAM ==========
     def _telegram_listener(self):
         """Lắng nghe tin nhắn từ Telegram"""
@@ -1262,7 +1489,7 @@ class BotManager:
         
         elif text == "📈 Vị thế":
             try:
-                open_positions = db_manager.get_open_positions()
+                open_positions = state_repository.get_open_positions()
                 
                 if not open_positions:
                     send_telegram("📭 Không có vị thế mở", chat_id=chat_id,
@@ -1349,8 +1576,8 @@ class BotManager:
             balance = get_balance(self.api_key, self.api_secret)
             api_status = "✅ Đã kết nối" if balance is not None else "❌ Lỗi kết nối"
             
-            all_bots = db_manager.get_all_bots()
-            open_positions = db_manager.get_open_positions()
+            all_bots = state_repository.get_all_bots()
+            open_positions = state_repository.get_open_positions()
             
             static_bots = [b for b in all_bots if b['bot_mode'] == 'static']
             dynamic_bots = [b for b in all_bots if b['bot_mode'] == 'dynamic']
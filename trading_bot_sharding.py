@@ -0,0 +1,660 @@
+# trading_bot_sharding.py
+# PHẦN 6: CHIA BOT RA NHIỀU TIẾN TRÌNH (SHARD) ĐỂ VƯỢT GIỚI HẠN GIL
+
+from trading_bot_lib_part1 import logger, exclude_margin_guardian, WebSocketManager
+from trading_bot_lib_part3 import BotManager
+
+import itertools
+import json
+import multiprocessing
+import queue
+import struct
+import threading
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import websocket
+
+
+# ========== CHỌN SHARD ==========
+SHARD_BY_BOT = "bot"
+SHARD_BY_ACCOUNT = "account"
+
+
+def shard_for(bot_id, api_key, shard_count, shard_by=SHARD_BY_BOT):
+    """Chọn shard cho bot: theo hash bot_id hoặc theo tài khoản (crc32 ổn định giữa các tiến trình)"""
+    if shard_count <= 1:
+        return 0
+    key = api_key if shard_by == SHARD_BY_ACCOUNT else bot_id
+    return zlib.crc32(str(key or "").encode("utf-8")) % shard_count
+
+
+# ========== BẢNG GIÁ CHIA SẺ GIỮA CÁC TIẾN TRÌNH ==========
+class SharedPriceBoard:
+    """
+    Bảng giá trên multiprocessing.shared_memory: một tiến trình feed ghi, mọi tiến trình khác đọc trực tiếp.
+    - Header: capacity, số slot đã cấp
+    - Mỗi slot: symbol, seq, price, timestamp; seq lẻ = đang ghi (seqlock chống đọc rách)
+    - Chỉ tiến trình feed cấp slot mới, nên symbol -> slot không bao giờ đổi
+    """
+
+    _HEADER = struct.Struct("<II")
+    _HEADER_SIZE = 16
+    _SLOT = struct.Struct("<16sQdd")
+    _SEQ = struct.Struct("<Q")
+    _VALUE = struct.Struct("<dd")
+
+    def __init__(self, name=None, capacity=1024, create=False):
+        self.create = create
+        if create:
+            size = self._HEADER_SIZE + capacity * self._SLOT.size
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self.shm.buf[:size] = bytes(size)
+            self._HEADER.pack_into(self.shm.buf, 0, capacity, 0)
+        else:
+            # Tiến trình con dùng chung resource_tracker với tiến trình tạo nên không cần hủy đăng ký
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.capacity = self._HEADER.unpack_from(self.shm.buf, 0)[0]
+        self._slots = {}
+        self._known = 0
+        self._lock = threading.Lock()
+
+    def _offset(self, index):
+        return self._HEADER_SIZE + index * self._SLOT.size
+
+    def _count(self):
+        return self._HEADER.unpack_from(self.shm.buf, 0)[1]
+
+    def _sync_index(self):
+        """Đọc thêm các slot mới được feed cấp từ lần trước"""
+        count = self._count()
+        if count == self._known:
+            return
+        with self._lock:
+            for index in range(self._known, count):
+                raw = self._SLOT.unpack_from(self.shm.buf, self._offset(index))[0]
+                self._slots[raw.rstrip(b"\0").decode("ascii")] = index
+            self._known = count
+
+    def slot_for(self, symbol):
+        """Cấp (hoặc trả lại) slot cho symbol — chỉ gọi từ tiến trình feed"""
+        self._sync_index()
+        index = self._slots.get(symbol)
+        if index is not None:
+            return index
+        with self._lock:
+            count = self._count()
+            if count >= self.capacity:
+                raise ValueError(f"Bảng giá đã đầy ({self.capacity} symbol)")
+            self._SLOT.pack_into(self.shm.buf, self._offset(count), symbol.encode("ascii")[:16], 0, 0.0, 0.0)
+            # Tăng count sau cùng: reader chỉ thấy slot khi đã ghi xong symbol
+            self._HEADER.pack_into(self.shm.buf, 0, self.capacity, count + 1)
+            self._slots[symbol] = count
+            self._known = count + 1
+            return count
+
+    def write(self, symbol, price, timestamp=None):
+        """Ghi giá theo seqlock: seq lẻ -> ghi giá trị -> seq chẵn"""
+        offset = self._offset(self.slot_for(symbol)) + 16
+        seq = self._SEQ.unpack_from(self.shm.buf, offset)[0]
+        self._SEQ.pack_into(self.shm.buf, offset, seq + 1)
+        self._VALUE.pack_into(self.shm.buf, offset + 8, price, timestamp or time.time())
+        self._SEQ.pack_into(self.shm.buf, offset, seq + 2)
+
+    def read(self, symbol, retries=100):
+        """Đọc (price, timestamp, seq) không khóa; None nếu symbol chưa có giá"""
+        index = self._slots.get(symbol)
+        if index is None:
+            self._sync_index()
+            index = self._slots.get(symbol)
+            if index is None:
+                return None
+        offset = self._offset(index) + 16
+        for _ in range(retries):
+            seq = self._SEQ.unpack_from(self.shm.buf, offset)[0]
+            if seq & 1:
+                continue
+            price, timestamp = self._VALUE.unpack_from(self.shm.buf, offset + 8)
+            if self._SEQ.unpack_from(self.shm.buf, offset)[0] == seq:
+                return (price, timestamp, seq) if seq else None
+        return None
+
+    def close(self):
+        self.shm.close()
+        if self.create:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+_STREAMS_PER_CONNECTION = 200
+
+
+def _price_feed_main(board_name, requests, stop_event):
+    """Tiến trình feed: một nhóm kết nối WebSocket cho mọi symbol được yêu cầu, ghi giá vào bảng chia sẻ"""
+    board = SharedPriceBoard(board_name)
+    connections = []
+
+    def run_connection(conn):
+        def on_open(ws):
+            with conn['lock']:
+                streams = [f"{symbol.lower()}@trade" for symbol in conn['symbols']]
+                conn['ws'] = ws
+            if streams:
+                ws.send(json.dumps({"method": "SUBSCRIBE", "params": streams, "id": int(time.time() * 1000)}))
+
+        def on_message(ws, message):
+            try:
+                data = json.loads(message)
+                if data.get('e') == 'trade':
+                    board.write(data['s'], float(data['p']), data.get('T', 0) / 1000.0 or None)
+            except Exception as e:
+                logger.error(f"Lỗi tin nhắn feed giá: {str(e)}")
+
+        def on_close(ws, close_status_code, close_msg):
+            with conn['lock']:
+                conn['ws'] = None
+
+        while not stop_event.is_set():
+            ws = websocket.WebSocketApp("wss://fstream.binance.com/ws", on_open=on_open,
+                                        on_message=on_message, on_close=on_close)
+            ws.run_forever(ping_interval=180)
+            if not stop_event.is_set():
+                time.sleep(5)
+
+    def subscribe(symbol):
+        board.slot_for(symbol)
+        for conn in connections:
+            with conn['lock']:
+                if symbol in conn['symbols']:
+                    return
+        conn = next((c for c in connections if len(c['symbols']) < _STREAMS_PER_CONNECTION), None)
+        if conn is None:
+            conn = {'symbols': set(), 'ws': None, 'lock': threading.Lock()}
+            connections.append(conn)
+            threading.Thread(target=run_connection, args=(conn,), daemon=True).start()
+        with conn['lock']:
+            conn['symbols'].add(symbol)
+            ws = conn['ws']
+        if ws is not None:
+            try:
+                ws.send(json.dumps({"method": "SUBSCRIBE", "params": [f"{symbol.lower()}@trade"],
+                                    "id": int(time.time() * 1000)}))
+            except Exception as e:
+                logger.error(f"Lỗi đăng ký feed giá {symbol}: {str(e)}")
+        logger.info(f"🔗 Feed giá đã thêm {symbol}")
+
+    while not stop_event.is_set():
+        try:
+            symbol = requests.get(timeout=1)
+        except queue.Empty:
+            continue
+        except (EOFError, OSError):
+            break
+        try:
+            subscribe(symbol.upper())
+        except Exception as e:
+            logger.error(f"❌ Lỗi feed giá {symbol}: {str(e)}")
+
+    for conn in connections:
+        if conn['ws'] is not None:
+            try:
+                conn['ws'].close()
+            except Exception:
+                pass
+    board.close()
+
+
+class SharedPriceWebSocketManager(WebSocketManager):
+    """
+    WebSocketManager đọc giá từ SharedPriceBoard thay vì tự mở WebSocket.
+    Symbol mới được gửi cho tiến trình feed; tick được phát cho bot qua cùng luồng như WebSocketManager.
+    """
+
+    def __init__(self, board_name, requests, poll_interval=0.1):
+        super().__init__()
+        self.board = SharedPriceBoard(board_name)
+        self.requests = requests
+        self.poll_interval = poll_interval
+        self._last_seq = {}
+        threading.Thread(target=self._poll_loop, daemon=True, name="price-board").start()
+
+    def add_symbol(self, symbol, callback):
+        if not symbol: return
+        symbol = symbol.upper()
+        with self._lock:
+            if symbol in self.connections:
+                return
+            self.connections[symbol] = {'callback': callback}
+        self.requests.put(symbol)
+
+    def remove_symbol(self, symbol):
+        if not symbol: return
+        with self._lock:
+            self.connections.pop(symbol.upper(), None)
+
+    def get_cached_price(self, symbol, max_age=5):
+        """Đọc thẳng bảng giá chia sẻ (kể cả symbol tiến trình này không theo dõi)"""
+        value = self.board.read(symbol.upper())
+        if value is None:
+            return None
+        price, timestamp, _ = value
+        return price if time.time() - timestamp < max_age else None
+
+    def _poll_loop(self):
+        while not self._stop_event.is_set():
+            with self._lock:
+                watched = list(self.connections.items())
+            for symbol, conn in watched:
+                value = self.board.read(symbol)
+                if value is None or self._last_seq.get(symbol) == value[2]:
+                    continue
+                self._last_seq[symbol] = value[2]
+                try:
+                    self._publish_price(symbol, value[0], conn['callback'])
+                except Exception as e:
+                    logger.error(f"Lỗi phát giá {symbol}: {str(e)}")
+            self._stop_event.wait(self.poll_interval)
+
+    def stop(self):
+        self._stop_event.set()
+        with self._lock:
+            self.connections.clear()
+        self.board.close()
+
+
+# ========== PHÍA WORKER ==========
+class ShardWorkerManager(BotManager):
+    """BotManager chạy trong tiến trình worker: chỉ giữ các bot thuộc shard của mình, không nghe Telegram"""
+
+    handles_telegram = False
+
+    def __init__(self, shard_index, shard_count, shard_by, api_key=None, api_secret=None,
+                 telegram_bot_token=None, telegram_chat_id=None, price_board=None, price_requests=None):
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.shard_by = shard_by
+        self.price_board = price_board
+        self.price_requests = price_requests
+        # Supervisor giữ bộ bảo vệ ký quỹ của tài khoản chính: worker không tự poll và tự đóng khẩn cấp
+        if api_key:
+            exclude_margin_guardian(api_key)
+        super().__init__(api_key=api_key, api_secret=api_secret,
+                         telegram_bot_token=telegram_bot_token, telegram_chat_id=telegram_chat_id)
+
+    def _create_ws_manager(self):
+        if self.price_board:
+            return SharedPriceWebSocketManager(self.price_board, self.price_requests)
+        return WebSocketManager()
+
+    def _owns_bot_config(self, bot_config):
+        api_key = bot_config.get('api_key') or self.api_key
+        return shard_for(bot_config['bot_id'], api_key, self.shard_count, self.shard_by) == self.shard_index
+
+    def _attach_margin_guardian(self, api_key, api_secret):
+        """Đóng khẩn cấp cấp tài khoản do supervisor điều phối qua mọi shard"""
+        return None
+
+    def describe_bots(self):
+        """Danh sách bot của shard: {bot_id: [symbol đang theo dõi]}"""
+        return {bot_id: list(getattr(bot, 'active_symbols', [])) for bot_id, bot in list(self.bots.items())}
+
+    def get_active_coins(self):
+        return self.coin_manager.get_active_coins()
+
+    def get_queue_info(self):
+        return self.bot_coordinator.get_queue_info()
+
+
+# Các hàm supervisor được phép gọi sang worker
+_RPC_METHODS = {
+    "add_bot", "stop_bot", "stop_all", "stop_coin", "stop_all_coins", "emergency_flatten",
+    "describe_bots", "get_active_coins", "get_queue_info",
+}
+
+
+def _shard_worker_main(conn, shard_index, shard_count, shard_by, api_key, api_secret,
+                       telegram_bot_token, telegram_chat_id, price_board=None, price_requests=None):
+    """Điểm vào tiến trình worker: dựng BotManager của shard rồi phục vụ RPC qua Pipe"""
+    send_lock = threading.Lock()
+
+    def reply(request_id, status, payload):
+        with send_lock:
+            try:
+                conn.send((request_id, status, payload))
+            except Exception as e:
+                logger.error(f"❌ Shard {shard_index}: lỗi gửi phản hồi RPC: {str(e)}")
+
+    try:
+        manager = ShardWorkerManager(shard_index, shard_count, shard_by, api_key=api_key, api_secret=api_secret,
+                                     telegram_bot_token=telegram_bot_token, telegram_chat_id=telegram_chat_id,
+                                     price_board=price_board, price_requests=price_requests)
+    except Exception as e:
+        reply(0, "error", f"Không khởi tạo được shard: {str(e)}")
+        return
+    reply(0, "ok", len(manager.bots))
+    logger.info(f"✅ Shard {shard_index}/{shard_count} sẵn sàng với {len(manager.bots)} bot")
+
+    # Mỗi lời gọi chạy trên luồng riêng: một lệnh chậm (đóng khẩn cấp) không chặn lệnh khác
+    executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix=f"shard{shard_index}-rpc")
+
+    def handle(request_id, method, args, kwargs):
+        try:
+            reply(request_id, "ok", getattr(manager, method)(*args, **kwargs))
+        except Exception as e:
+            logger.error(f"❌ Shard {shard_index}: lỗi RPC {method}: {str(e)}")
+            reply(request_id, "error", str(e))
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            # Supervisor đã thoát: kết thúc tiến trình, vị thế trên sàn giữ nguyên như khi restart
+            break
+        if message is None:
+            break
+        request_id, method, args, kwargs = message
+        if method not in _RPC_METHODS:
+            reply(request_id, "error", f"Không hỗ trợ {method}")
+            continue
+        executor.submit(handle, request_id, method, args, kwargs)
+
+    executor.shutdown(wait=False)
+
+
+# ========== PHÍA SUPERVISOR ==========
+class _ShardHandle:
+    """Kết nối tới một tiến trình worker: gửi lời gọi, nhận kết quả qua Future theo request_id"""
+
+    def __init__(self, index, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self._ids = itertools.count(1)
+        self._pending = {0: Future()}
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True, name=f"shard{index}-reader")
+        self._reader.start()
+
+    def _read_loop(self):
+        while True:
+            try:
+                request_id, status, payload = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                future = self._pending.pop(request_id, None)
+            if future is None:
+                continue
+            if status == "ok":
+                future.set_result(payload)
+            else:
+                future.set_exception(RuntimeError(payload))
+
+        # Worker chết: báo lỗi cho mọi lời gọi còn chờ
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(RuntimeError(f"Shard {self.index} đã dừng"))
+
+    def wait_ready(self, timeout=None):
+        return self._pending[0].result(timeout=timeout)
+
+    def submit(self, method, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+            try:
+                self.conn.send((request_id, method, args, kwargs))
+            except Exception as e:
+                self._pending.pop(request_id, None)
+                future.set_exception(e)
+        return future
+
+    def call(self, method, *args, timeout=60, **kwargs):
+        return self.submit(method, *args, **kwargs).result(timeout=timeout)
+
+    def close(self, timeout=5):
+        try:
+            with self._lock:
+                self.conn.send(None)
+        except Exception:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class RemoteBot:
+    """Bản tóm tắt bot ở worker để supervisor liệt kê (Telegram, REST)"""
+
+    def __init__(self, bot_id, shard, active_symbols):
+        self.bot_id = bot_id
+        self.shard = shard
+        self.active_symbols = active_symbols
+
+
+class _ShardedCoinView:
+    """Thay CoinManager ở supervisor: gộp coin đang hoạt động từ các shard"""
+
+    def __init__(self, manager):
+        self._manager = manager
+
+    def get_active_coins(self):
+        coins = set()
+        for result in self._manager._broadcast("get_active_coins").values():
+            coins.update(result or [])
+        return list(coins)
+
+
+class _ShardedQueueView:
+    """Thay BotExecutionCoordinator ở supervisor: gộp thông tin hàng đợi từ các shard"""
+
+    def __init__(self, manager):
+        self._manager = manager
+
+    def get_queue_info(self):
+        merged = {'current_finding': None, 'queue_size': 0, 'queue_bots': [],
+                  'bots_with_coins': [], 'found_coins_count': 0}
+        for info in self._manager._broadcast("get_queue_info").values():
+            if not info:
+                continue
+            merged['current_finding'] = merged['current_finding'] or info.get('current_finding')
+            merged['queue_size'] += info.get('queue_size', 0)
+            merged['queue_bots'].extend(info.get('queue_bots', []))
+            merged['bots_with_coins'].extend(info.get('bots_with_coins', []))
+            merged['found_coins_count'] += info.get('found_coins_count', 0)
+        return merged
+
+
+class ShardedBotManager(BotManager):
+    """
+    Supervisor: nghe Telegram/REST như BotManager nhưng bot chạy trong các tiến trình worker.
+    - Chia bot theo hash bot_id hoặc theo tài khoản
+    - Giá thời gian thực: một tiến trình feed ghi SharedPriceBoard, mọi worker đọc chung
+    - Mỗi worker có cache sàn riêng; bộ bảo vệ ký quỹ tài khoản chính chỉ chạy ở supervisor,
+      khi vượt ngưỡng thì đóng khẩn cấp qua mọi shard rồi mới quét vị thế ngoài bot
+    - Lời gọi API của BotManager được chuyển tới worker sở hữu bot
+    """
+
+    def __init__(self, api_key=None, api_secret=None, telegram_bot_token=None, telegram_chat_id=None,
+                 shard_count=2, shard_by=SHARD_BY_BOT, route_refresh_interval=5.0, price_capacity=1024):
+        self.shard_count = max(1, int(shard_count))
+        self.shard_by = shard_by if shard_by in (SHARD_BY_BOT, SHARD_BY_ACCOUNT) else SHARD_BY_BOT
+        self.route_refresh_interval = route_refresh_interval
+        self._shards = []
+        self._routes_lock = threading.Lock()
+
+        # spawn: không kế thừa luồng/kết nối DB đang mở của supervisor
+        self._ctx = multiprocessing.get_context("spawn")
+        self.price_board = SharedPriceBoard(capacity=price_capacity, create=True)
+        self.price_requests = self._ctx.Queue()
+        self._feed_stop = self._ctx.Event()
+        self._feed_process = self._ctx.Process(
+            target=_price_feed_main,
+            args=(self.price_board.name, self.price_requests, self._feed_stop),
+            name="price-feed",
+            daemon=True
+        )
+        self._feed_process.start()
+
+        super().__init__(api_key=api_key, api_secret=api_secret,
+                         telegram_bot_token=telegram_bot_token, telegram_chat_id=telegram_chat_id)
+        threading.Thread(target=self._route_refresh_loop, daemon=True, name="shard-routes").start()
+
+    def _create_ws_manager(self):
+        """Supervisor (web/Telegram) cũng đọc giá từ bảng chia sẻ, không mở WebSocket riêng"""
+        return SharedPriceWebSocketManager(self.price_board.name, self.price_requests)
+
+    # ========== KHỞI ĐỘNG WORKER ==========
+    def _restore_bots_from_db(self):
+        """Supervisor không tự dựng bot: khởi động worker, mỗi worker khôi phục phần bot của mình"""
+        self.coin_manager = _ShardedCoinView(self)
+        self.bot_coordinator = _ShardedQueueView(self)
+
+        ctx = self._ctx
+        for index in range(self.shard_count):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=_shard_worker_main,
+                args=(child_conn, index, self.shard_count, self.shard_by, self.api_key, self.api_secret,
+                      self.telegram_bot_token, self.telegram_chat_id, self.price_board.name, self.price_requests),
+                name=f"bot-shard-{index}",
+                daemon=True
+            )
+            process.start()
+            child_conn.close()
+            self._shards.append(_ShardHandle(index, process, parent_conn))
+
+        restored = 0
+        for shard in self._shards:
+            try:
+                restored += shard.wait_ready(timeout=300) or 0
+            except Exception as e:
+                self.log(f"❌ Shard {shard.index} không khởi động được: {str(e)}")
+
+        self._refresh_routes()
+        self.log(f"✅ Đã khởi động {self.shard_count} shard ({self.shard_by}) với {restored} bot")
+
+    # ========== ĐỊNH TUYẾN ==========
+    def _broadcast(self, method, *args, timeout=60, **kwargs):
+        """Gọi song song tới mọi shard, trả {shard_index: kết quả} (bỏ qua shard lỗi)"""
+        futures = [(shard, shard.submit(method, *args, **kwargs)) for shard in self._shards]
+        results = {}
+        for shard, future in futures:
+            try:
+                results[shard.index] = future.result(timeout=timeout)
+            except Exception as e:
+                logger.error(f"❌ Shard {shard.index}: lỗi {method}: {str(e)}")
+        return results
+
+    def _refresh_routes(self):
+        """Cập nhật self.bots từ các worker (bot_id -> RemoteBot)"""
+        bots = {}
+        for index, described in self._broadcast("describe_bots", timeout=10).items():
+            for bot_id, symbols in (described or {}).items():
+                bots[bot_id] = RemoteBot(bot_id, index, symbols)
+        with self._routes_lock:
+            self.bots = bots
+
+    def _route_refresh_loop(self):
+        while self.running:
+            time.sleep(self.route_refresh_interval)
+            try:
+                self._refresh_routes()
+            except Exception as e:
+                logger.error(f"❌ Lỗi cập nhật định tuyến shard: {str(e)}")
+
+    def _shard_of_bot(self, bot_id):
+        bot = self.bots.get(bot_id)
+        if bot is not None:
+            return self._shards[bot.shard]
+        # Bot không còn chạy (chỉ còn cấu hình trong DB): suy ra shard như lúc khôi phục
+        return self._shards[shard_for(bot_id, self.api_key, self.shard_count, self.shard_by)]
+
+    # ========== API BOTMANAGER ĐƯỢC ĐỊNH TUYẾN ==========
+    def add_bot(self, bot_mode, bot_type, lev, percent, tp, sl, roi_trigger,
+                symbol=None, bot_count=1, **kwargs):
+        """Sinh bot_id tại supervisor rồi chia nhóm theo shard sở hữu"""
+        dynamic_strategy = kwargs.get('dynamic_strategy', 'volume')
+        groups = defaultdict(list)
+        for i in range(bot_count):
+            bot_id = self._new_bot_id(bot_mode, symbol, dynamic_strategy, i)
+            groups[shard_for(bot_id, self.api_key, self.shard_count, self.shard_by)].append(bot_id)
+
+        ok = False
+        for index, bot_ids in groups.items():
+            try:
+                ok = self._shards[index].call("add_bot", bot_mode, bot_type, lev, percent, tp, sl, roi_trigger,
+                                              symbol=symbol, bot_count=len(bot_ids),
+                                              **dict(kwargs, bot_ids=bot_ids)) or ok
+            except Exception as e:
+                self.log(f"❌ Lỗi tạo bot ở shard {index}: {str(e)}")
+        self._refresh_routes()
+        return ok
+
+    def stop_bot(self, bot_id, delete_config: bool = False, hard_delete: bool = False):
+        try:
+            ok = self._shard_of_bot(bot_id).call("stop_bot", bot_id, delete_config=delete_config,
+                                                 hard_delete=hard_delete)
+        except Exception as e:
+            self.log(f"❌ Lỗi dừng bot {bot_id}: {str(e)}")
+            ok = False
+        self._refresh_routes()
+        return ok
+
+    def stop_all(self):
+        self._broadcast("stop_all", timeout=120)
+        self._refresh_routes()
+
+    def stop_coin(self, symbol):
+        return any(self._broadcast("stop_coin", symbol).values())
+
+    def stop_all_coins(self):
+        return sum(self._broadcast("stop_all_coins", timeout=120).values())
+
+    def emergency_flatten(self, api_key=None, deadline=10.0, max_workers=8, reason="🚨 Đóng khẩn cấp",
+                          include_unmanaged=True):
+        """Các shard đóng vị thế bot song song, sau đó một shard quét vị thế ngoài bot trong thời gian còn lại"""
+        start_time = time.time()
+        api_key = api_key or self.api_key
+        reports = list(self._broadcast("emergency_flatten", api_key, deadline=deadline, max_workers=max_workers,
+                                       reason=reason, include_unmanaged=False, timeout=deadline + 30).values())
+
+        remaining = deadline - (time.time() - start_time)
+        if include_unmanaged and remaining > 0 and self._shards:
+            sweeper = self._shards[shard_for(None, api_key, self.shard_count, self.shard_by)
+                                   if self.shard_by == SHARD_BY_ACCOUNT else 0]
+            try:
+                reports.append(sweeper.call("emergency_flatten", api_key, deadline=remaining,
+                                            max_workers=max_workers, reason=reason, timeout=remaining + 30))
+            except Exception as e:
+                logger.error(f"❌ Lỗi quét vị thế ngoài bot: {str(e)}")
+
+        report = {'closed': [], 'failed': [], 'attempts': {}, 'elapsed': 0}
+        for part in reports:
+            if not part:
+                continue
+            report['closed'].extend(part.get('closed', []))
+            report['failed'].extend(part.get('failed', []))
+            report['attempts'].update(part.get('attempts', {}))
+        report['failed'] = [symbol for symbol in report['failed'] if symbol not in report['closed']]
+        report['elapsed'] = round(time.time() - start_time, 2)
+        return report
+
+    def shutdown(self):
+        """Dừng các tiến trình worker (bot vẫn 'running' trong DB để khôi phục lần sau)"""
+        self.running = False
+        for shard in self._shards:
+            shard.close()
+        self._feed_stop.set()
+        self._feed_process.join(5)
+        self.ws_manager.stop()
+        self.price_board.close()